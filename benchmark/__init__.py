@@ -0,0 +1 @@
+# Benchmarks for etl_mts_771.py, see benchmark/harness.py
@@ -0,0 +1,112 @@
+#############################################################
+'''
+Synthetic MTS .dat files for the benchmarks.
+
+Files look like the ones the stations export: blocks of Data Header / Station Name / Test File Name lines,
+then the column headers, a units row and tab separated data rows, with CRLF line endings.
+
+    python -m benchmark.generate <directory> --table rotary --rows 100000 --blocks 10
+'''
+#############################################################
+import os
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Column headers and units per table, the first header that is unique to a table decides where the rows go
+TABLE_COLUMNS = {
+    'table_top': [('Time', 'Sec'), ('Ch 1 Output', 'kN'), ('Ch 1 Command', 'kN'), ('Ch 1 Displacement', 'mm'),
+                  ('Ch 2 Output', 'kN'), ('Ch 2 Command', 'kN'), ('Ch 2 Displacement', 'mm'), ('Count', 'segments')],
+    'rotary': [('Time', 'Sec'), ('Rotary Output', 'N-m'), ('Rotary Command', 'N-m'), ('Rotary Angle', 'deg'),
+               ('Rotary Velocity', 'deg/s'), ('Count', 'segments')],
+    'mts_810': [('Time', 'Sec'), ('Axial Output', 'kN'), ('Axial Command', 'kN'), ('Axial Displacement', 'mm'),
+                ('Axial Strain', 'mm/mm'), ('Count', 'segments')],
+}
+
+STATIONS = {'table_top': 'TableTop_771', 'rotary': 'Rotary_771', 'mts_810': 'Axial_810'}
+
+def header_lines(table_name, header_time, test_file_name, station_name=None):
+    columns = TABLE_COLUMNS[table_name]
+    return [
+        f"Data Header:\tMTS 793\tStation Manager\tData Acquisition\t{header_time.strftime('%m/%d/%Y %I:%M:%S %p')}",
+        f"Station Name: {station_name or STATIONS[table_name]}",
+        f"Test File Name: {test_file_name}",
+        "\t".join(name for name, _ in columns),
+        "\t".join(unit for _, unit in columns),
+    ]
+
+def data_lines(table_name, rows, start_row=0, malformed_every=0, rng=None):
+    # Time steps by 10 ms, the channels are noisy sine waves. Every malformed_every-th row is broken on purpose,
+    # alternating between a missing column and a non-numeric cell, the ETL should drop both.
+    rng = rng or random.Random(0)
+    channels = len(TABLE_COLUMNS[table_name]) - 2
+    lines = []
+    for i in range(start_row, start_row + rows):
+        if malformed_every and i % malformed_every == malformed_every - 1:
+            lines.append(f"{i * 0.01:.3f}\t{rng.random():.6f}" if i % 2 else f"{i * 0.01:.3f}\t" + "\t".join(["n/a"] * (channels + 1)))
+            continue
+        values = [f"{(k + 1) * 10 * rng.random():.6f}" for k in range(channels)]
+        lines.append(f"{i * 0.01:.3f}\t" + "\t".join(values) + f"\t{i // 1000}")
+    return lines
+
+def write_dat_file(file_path, table_name, rows, blocks=1, malformed_every=0, start_time=None, seed=0, station_name=None):
+    # Writes rows split over blocks, each block starting with its own Data Header. Returns the size in bytes.
+    rng = random.Random(seed)
+    start_time = start_time or datetime(2024, 1, 2, 8, 0, 0)
+    test_file_name = os.path.splitext(os.path.basename(file_path))[0] + ".tst"
+    rows_per_block = max(1, rows // blocks)
+
+    with open(file_path, 'w', newline='') as f:
+        written = 0
+        block = 0
+        while written < rows:
+            block_rows = min(rows_per_block, rows - written)
+            lines = header_lines(table_name, start_time + timedelta(minutes=block), test_file_name, station_name)
+            lines += data_lines(table_name, block_rows, written, malformed_every, rng)
+            f.write("\r\n".join(lines) + "\r\n")
+            written += block_rows
+            block += 1
+    return os.path.getsize(file_path)
+
+def append_to_dat_file(file_path, table_name, rows, new_block=True, start_row=0, malformed_every=0, header_time=None, seed=0):
+    # Adds rows to the end of a file the way a running test does, either as a new block with its own Data Header
+    # or as more rows of the block that is already open. Returns the number of bytes added.
+    rng = random.Random(seed)
+    size_before = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    lines = []
+    if new_block:
+        test_file_name = os.path.splitext(os.path.basename(file_path))[0] + ".tst"
+        lines += header_lines(table_name, header_time or datetime.now().replace(microsecond=0), test_file_name)
+    lines += data_lines(table_name, rows, start_row, malformed_every, rng)
+
+    with open(file_path, 'a', newline='') as f:
+        f.write("\r\n".join(lines) + "\r\n")
+    return os.path.getsize(file_path) - size_before
+
+def write_dataset(directory, tables, files_per_table, rows_per_file, blocks=1, malformed_every=0, seed=0):
+    # files_per_table files for each table, named <table>_<n>.dat. Returns the paths and the total size in bytes.
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    total_bytes = 0
+    for table_name in tables:
+        for n in range(files_per_table):
+            file_path = os.path.join(directory, f"{table_name}_{n:04d}.dat")
+            total_bytes += write_dat_file(file_path, table_name, rows_per_file, blocks, malformed_every,
+                                          seed=seed + n, start_time=datetime(2024, 1, 2, 8, 0, 0) + timedelta(hours=n))
+            paths.append(file_path)
+    return paths, total_bytes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic MTS .dat files.")
+    parser.add_argument('directory')
+    parser.add_argument('--table', choices=sorted(TABLE_COLUMNS), action='append', help="table the files are for, can be repeated (default all three)")
+    parser.add_argument('--files', type=int, default=1, help="files per table")
+    parser.add_argument('--rows', type=int, default=100000, help="data rows per file")
+    parser.add_argument('--blocks', type=int, default=1, help="Data Header blocks per file")
+    parser.add_argument('--malformed-every', type=int, default=0, help="break every n-th row, 0 for none")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths, total_bytes = write_dataset(args.directory, args.table or sorted(TABLE_COLUMNS), args.files, args.rows,
+                                       args.blocks, args.malformed_every, args.seed)
+    print(f"Wrote {len(paths)} files, {total_bytes / 1024**2:.1f} MB, to {args.directory}")
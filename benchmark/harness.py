@@ -0,0 +1,266 @@
+#############################################################
+'''
+End-to-end ingest benchmark for etl_mts_771.py.
+
+Each workload runs in its own process against synthetic .dat files from benchmark/generate.py:
+    cold         a few large files loaded from the first line
+    incremental  files already loaded, then several rounds of appended blocks
+    many_small   a lot of small files loaded from the first line
+
+    python -m benchmark.harness --db postgres     # DB_* from .env, writes to <DB_NAME>_bench and <DB_NAME>_bench_ts
+    python -m benchmark.harness --db null         # no database, rows are serialised for COPY and thrown away
+
+Rows/s, MB/s, peak RSS and the time spent in each stage are written to benchmark/results/ as JSON.
+Pass --compare with an older report to see the change per workload, the exit code is 1 if anything got slower
+by more than --tolerance.
+'''
+#############################################################
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+from benchmark.generate import TABLE_COLUMNS, write_dataset, append_to_dat_file
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ETL_SCRIPT = os.path.join(REPO_DIRECTORY, 'etl_mts_771.py')
+BENCH_TABLES = sorted(TABLE_COLUMNS)
+
+WORKLOADS = {
+    # name: files per table, rows per file, Data Header blocks per file, append rounds, rows per append
+    'cold': dict(files=1, rows=200000, blocks=20, rounds=0, append_rows=0),
+    'incremental': dict(files=4, rows=20000, blocks=4, rounds=10, append_rows=2000),
+    'many_small': dict(files=200, rows=200, blocks=1, rounds=0, append_rows=0),
+}
+
+def etl_version():
+    with open(ETL_SCRIPT, encoding='utf-8') as f:
+        match = re.search(r'^Version:\s*(\S+)', f.read(), re.MULTILINE)
+    return match.group(1) if match else 'unknown'
+
+def peak_rss_mb(): # Highest resident set size of this process so far
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KB on Linux
+    except ImportError: # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024**2
+        except ImportError:
+            return None
+
+############################################################# Stage timing
+def stage_report(etl):
+    # The ETL's own stage metrics (see StageMetrics in etl_mts_771.py), added up over stations and tables
+    stages = {}
+    with etl.metrics.lock:
+        for (stage, _, _), (calls, seconds, rows, byte_count, errors) in etl.metrics.stages.items():
+            totals = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0, 'errors': 0})
+            totals['calls'] += calls
+            totals['seconds'] += seconds
+            totals['rows'] += rows
+            totals['bytes'] += byte_count
+            totals['errors'] += errors
+    for totals in stages.values():
+        totals['seconds'] = round(totals['seconds'], 4)
+    return dict(sorted(stages.items()))
+
+############################################################# Databases
+def prepare_postgres(etl, db_name):
+    # Point the ETL at throwaway benchmark databases and start from empty tables
+    from sqlalchemy import create_engine, text
+    etl.db_name = db_name
+    etl.timescale_db_name = f"{db_name}_ts"
+
+    admin_engine = create_engine(f'postgresql+psycopg2://{etl.db_username}:{etl.db_password}@{etl.db_host}:{etl.db_port}/postgres',
+                                 isolation_level='AUTOCOMMIT')
+    with admin_engine.connect() as conn:
+        existing = {row[0] for row in conn.execute(text("SELECT datname FROM pg_database"))}
+        for name in (etl.db_name, etl.timescale_db_name):
+            if name not in existing:
+                conn.execute(text(f'CREATE DATABASE "{name}"'))
+    admin_engine.dispose()
+
+    etl.connect_databases()
+    for target_engine, suffix in ((etl.engine, ''), (etl.timescale_engine, '_ts')):
+        with target_engine.begin() as conn:
+            for table_name in BENCH_TABLES:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}{suffix}" CASCADE'))
+                conn.execute(text(f'DROP SEQUENCE IF EXISTS "{table_name}{suffix}_id_seq" CASCADE'))
+            if not suffix:
+                conn.execute(text('DROP TABLE IF EXISTS etl_log, error_log CASCADE'))
+    etl.create_logging_tables_if_not_exists()
+
+def prepare_null(etl):
+    # Everything up to the database: rows are serialised exactly as for COPY, then dropped
+    etl.load_database_modules()
+    etl.define_logging_tables()
+    etl.upload_method = 'copy'
+    etl.sinks = [etl.DatabaseSink('primary', None, '', None), etl.DatabaseSink('timescale', None, '_ts', None)]
+    etl.sink_executor = etl.ThreadPoolExecutor(max_workers=len(etl.sinks) * etl.etl_workers, thread_name_prefix='sink')
+    etl.ensure_table_ready = lambda target_engine, table_name, df, create_table: True
+    etl.insert_with_copy = lambda df, table_name, target_engine, csv_text=None: csv_text if csv_text is not None else etl.copy_csv(df)
+    etl.append_to_log_file = lambda *args: None
+
+############################################################# Workloads
+def load_changes(etl, data_directory):
+    changes = etl.track_modified_files([data_directory])
+    etl.save_changes(changes, etl.file_fingerprints)
+    if changes:
+        etl.process_and_upload_files(list(changes))
+
+def run_workload(name, settings, db, db_name, malformed_every):
+    # Runs in a fresh process, so the peak RSS belongs to this workload only
+    work_directory = tempfile.mkdtemp(prefix=f"etl_bench_{name}_")
+    data_directory = os.path.join(work_directory, 'data')
+    os.chdir(work_directory) # The ETL's log files and state store go here
+    os.environ['STATE_DB'] = os.path.join(work_directory, 'etl_state.db')
+    os.environ['RETRY_QUEUE_DIRECTORY'] = os.path.join(work_directory, 'retry_queue')
+
+    generate_start = time.perf_counter()
+    paths, total_bytes = write_dataset(data_directory, BENCH_TABLES, settings['files'], settings['rows'], settings['blocks'], malformed_every)
+    generate_seconds = time.perf_counter() - generate_start
+
+    sys.path.insert(0, REPO_DIRECTORY)
+    import etl_mts_771 as etl
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            root.removeHandler(handler) # Keep the text log, but not one console line per batch
+
+    if db == 'postgres':
+        prepare_postgres(etl, db_name)
+    else:
+        prepare_null(etl)
+
+    if settings['rounds']: # Incremental: the existing files count as loaded, only the appends are timed
+        etl.initialize_state([data_directory])
+        total_bytes = 0
+
+    etl.metrics = etl.StageMetrics() # Count only what is timed below
+
+    start = time.perf_counter()
+    if settings['rounds']:
+        for round_number in range(settings['rounds']):
+            for n, file_path in enumerate(paths):
+                table_name = os.path.basename(file_path).rsplit('_', 1)[0]
+                total_bytes += append_to_dat_file(file_path, table_name, settings['append_rows'], new_block=round_number % 2 == 0,
+                                                  start_row=settings['rows'] + round_number * settings['append_rows'],
+                                                  malformed_every=malformed_every, seed=round_number * 1000 + n)
+            load_changes(etl, data_directory)
+    else:
+        load_changes(etl, data_directory)
+    elapsed = time.perf_counter() - start
+
+    for handler in list(root.handlers): # Drain the error_log queue before the numbers are taken
+        handler.flush()
+    stages = stage_report(etl)
+    rows = stages.get('insert_primary', {}).get('rows', 0)
+    etl.shutdown_parse_pool()
+    etl.close_state_store()
+    shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {
+        'files': len(paths),
+        'rows': rows,
+        'megabytes': round(total_bytes / 1024**2, 3),
+        'seconds': round(elapsed, 4),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed > 0 else None,
+        'megabytes_per_second': round(total_bytes / 1024**2 / elapsed, 3) if elapsed > 0 else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if peak_rss_mb() is not None else None,
+        'generate_seconds': round(generate_seconds, 4),
+        'stages': stages,
+        'settings': settings,
+    }
+
+############################################################# Reports
+def compare_reports(report, baseline, tolerance):
+    # Prints rows/s against the baseline per workload, returns the names of the workloads that got slower than tolerance allows
+    regressions = []
+    for name, result in report['workloads'].items():
+        old = baseline.get('workloads', {}).get(name)
+        if not old or not old.get('rows_per_second') or not result.get('rows_per_second'):
+            continue
+        change = result['rows_per_second'] / old['rows_per_second'] - 1
+        print(f"{name}: {old['rows_per_second']:.0f} -> {result['rows_per_second']:.0f} rows/s ({change:+.1%}) "
+              f"vs version {baseline.get('version')}")
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark etl_mts_771.py end to end on synthetic .dat files.")
+    parser.add_argument('--db', choices=['postgres', 'null'], default='postgres',
+                        help="postgres uses DB_* from the environment or .env, null skips the database")
+    parser.add_argument('--db-name', help="benchmark database, default <DB_NAME>_bench (a second one with _ts is used for TimescaleDB)")
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), action='append', help="can be repeated, default all")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the rows per file and per append")
+    parser.add_argument('--malformed-every', type=int, default=0, help="break every n-th generated row, 0 for none")
+    parser.add_argument('--output', default=os.path.join(REPO_DIRECTORY, 'benchmark', 'results'), help="directory for the JSON report")
+    parser.add_argument('--compare', help="earlier JSON report to compare rows/s with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown allowed by --compare before exiting with 1")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS) # Used by the parent process to run one workload
+    args = parser.parse_args()
+
+    if args.db == 'postgres' and not args.db_name:
+        from dotenv import load_dotenv
+        load_dotenv()
+        args.db_name = f"{os.getenv('DB_NAME', 'mts771')}_bench"
+
+    if args.run_one:
+        settings = json.loads(args.run_one)
+        name = settings.pop('name')
+        print(json.dumps(run_workload(name, settings, args.db, args.db_name, args.malformed_every)))
+        return 0
+
+    report = {
+        'version': etl_version(),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'db': args.db,
+        'scale': args.scale,
+        'malformed_every': args.malformed_every,
+        'workloads': {},
+    }
+    for name in args.workload or list(WORKLOADS):
+        settings = dict(WORKLOADS[name], name=name)
+        settings['rows'] = max(1, int(settings['rows'] * args.scale))
+        settings['append_rows'] = int(settings['append_rows'] * args.scale)
+        command = [sys.executable, '-m', 'benchmark.harness', '--db', args.db, '--malformed-every', str(args.malformed_every), '--run-one', json.dumps(settings)]
+        if args.db_name:
+            command += ['--db-name', args.db_name]
+        completed = subprocess.run(command, cwd=REPO_DIRECTORY, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            raise RuntimeError(f"Workload {name} failed")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        report['workloads'][name] = result
+        print(f"{name}: {result['rows']} rows, {result['megabytes']} MB in {result['seconds']}s "
+              f"({result['rows_per_second']} rows/s, {result['megabytes_per_second']} MB/s, peak RSS {result['peak_rss_mb']} MB)")
+
+    os.makedirs(args.output, exist_ok=True)
+    report_file = os.path.join(args.output, f"bench_{report['version']}_{args.db}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {report_file}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Slower than {args.compare} by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
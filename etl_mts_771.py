@@ -1,17 +1,31 @@
 ############################################################# 
 '''
-Version: 4
+Version: 6.14
  
 see below for version info.
 '''
 #############################################################
-import pandas as pd
 import os
+import sys
+import csv
+import io
+import time
+import locale
+import signal
+import argparse
+import socket
+import threading
+import itertools
+import queue
+import json
+import glob
+import hashlib
+import sqlite3
 import traceback
 import logging
-from sqlalchemy import create_engine, Integer, TIMESTAMP, MetaData, Table, Column, Float, String, BigInteger, insert
-from sqlalchemy.sql import text
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 ###################################################################### Setup and global variables
@@ -21,22 +35,93 @@ db_password = os.getenv('DB_PASSWORD')
 db_host = os.getenv('DB_HOST')
 db_port = os.getenv('DB_PORT')
 db_name = os.getenv('DB_NAME')
-engine = create_engine(f'postgresql+psycopg2://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}')
+engine = None # Both engines are created by connect_databases() once there is something to load
 
 #timescale stuff.
 timescale_db_name = 'mts771_ts' 
-timescale_engine = create_engine(f'postgresql+psycopg2://{db_username}:{db_password}@{db_host}:{db_port}/{timescale_db_name}')
+timescale_engine = None
+timescale_chunk_interval = os.getenv('TIMESCALE_CHUNK_INTERVAL', '7 days') # Hypertable chunk size, any PostgreSQL interval
+timescale_compress_after = os.getenv('TIMESCALE_COMPRESS_AFTER', '30 days') # Compress chunks older than this, empty turns compression off
+timescale_retention = os.getenv('TIMESCALE_RETENTION', '') # Drop chunks older than this, empty (the default) keeps everything
+timescale_time_column = os.getenv('TIMESCALE_TIME_COLUMN', 'header_timestamp')
+
+primary_partitioning = os.getenv('PRIMARY_PARTITIONING', '').lower() # 'month' or 'month,station' partitions the primary tables, empty keeps plain tables
+partition_months_ahead = int(os.getenv('PARTITION_MONTHS_AHEAD', 3)) # Monthly partitions made before any rows need them
+station_partitions = int(os.getenv('STATION_PARTITIONS', 8)) # Hash partitions on station_name in each month with 'month,station'
+
+dat_file_encoding = os.getenv('DAT_FILE_ENCODING') or locale.getpreferredencoding(False) # same default as opening the file in text mode
+upload_method = os.getenv('UPLOAD_METHOD', 'copy').lower() # 'copy' bulk loads with COPY FROM STDIN, 'to_sql' uses pandas inserts
+db_log_level = os.getenv('DB_LOG_LEVEL', 'DEBUG').upper() # Lowest level written to error_log, the text log and console always get DEBUG
+db_log_batch_size = int(os.getenv('DB_LOG_BATCH_SIZE', 500))
+db_log_flush_seconds = float(os.getenv('DB_LOG_FLUSH_SECONDS', 2))
+etl_workers = int(os.getenv('ETL_WORKERS', 4)) # Files processed at the same time, 1 turns off the worker pools
+batch_bytes = int(float(os.getenv('BATCH_MB', 16)) * 1024**2) # Largest piece of a file read, parsed and uploaded at once
+batch_rows = int(os.getenv('BATCH_ROWS', 100000))
+parse_process_min_bytes = int(os.getenv('PARSE_PROCESS_MIN_BYTES', 16 * 1024**2)) # Below this much new data parsing stays in threads
+pipeline_depth = int(os.getenv('PIPELINE_DEPTH', 2)) # Parsed batches per file waiting for upload, 0 reads, parses and uploads in turn
+rollup_windows = [w.strip() for w in os.getenv('ROLLUP_WINDOWS', '').split(',') if w.strip()] # e.g. 1s,1min,1h, empty turns rollups off
+coordination = os.getenv('COORDINATION', '').lower() # 'postgres' shares leases, checkpoints and etl_log_ids with other hosts, empty keeps them local
+lease_seconds = int(os.getenv('LEASE_SECONDS', 120)) # A file whose lease is not renewed for this long is taken over by another host
+worker_id = os.getenv('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
 
 etl_log_table = None
 error_log_table = None
 
-file_mod_times = {}  
+file_fingerprints = {} # path -> (mod_time, size, inode, head_hash) from the last scan
+
+# pandas and SQLAlchemy take most of the start up time of a run, and most scheduled runs find nothing to load.
+# They are imported, and the databases connected to, only when there is work to do.
+database_lock = threading.Lock()
+
+def load_database_modules():
+    global pd, np, create_engine, inspect, Integer, TIMESTAMP, MetaData, Table, Column, Float, String, BigInteger, insert, text, OperationalError
+    import pandas as pd
+    import numpy as np
+    from sqlalchemy import create_engine, inspect, Integer, TIMESTAMP, MetaData, Table, Column, Float, String, BigInteger, insert
+    from sqlalchemy.sql import text
+    from sqlalchemy.exc import OperationalError
+
+def connect_databases(): # Safe to call more than once, only the first call connects
+    global engine, timescale_engine, sinks, sink_executor
+    with database_lock:
+        if engine is not None:
+            return
+        load_database_modules()
+        engine = create_engine(f'postgresql+psycopg2://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}')
+        timescale_engine = create_engine(f'postgresql+psycopg2://{db_username}:{db_password}@{db_host}:{db_port}/{timescale_db_name}')
+        define_logging_tables()
+        logging.getLogger().addHandler(DatabaseLogHandler(level=db_log_level, batch_size=db_log_batch_size, flush_interval=db_log_flush_seconds))
+
+        sinks = [
+            DatabaseSink('primary', engine, '', create_table_if_not_exists_primary),
+            DatabaseSink('timescale', timescale_engine, '_ts', create_table_if_not_exists_ts),
+        ]
+        statement_timeouts.update({engine: primary_statement_timeout, timescale_engine: timescale_statement_timeout})
+        sink_executor = ThreadPoolExecutor(max_workers=len(sinks) * etl_workers, thread_name_prefix='sink')
 
 ############################################################# logging
 
 class DatabaseLogHandler(logging.Handler):
-    def __init__(self):
-        super().__init__()
+    # emit() only puts the record on a queue. A background thread writes the queue to error_log in batches, once
+    # batch_size records are waiting or flush_interval seconds after the first one. When the queue is full, or the
+    # database is down, records are dropped from the database only, the file handler still has every one of them.
+    def __init__(self, level=logging.NOTSET, batch_size=500, flush_interval=2.0, max_queue=10000):
+        super().__init__(level)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.pending = [] # Records waiting for error_log_table to be set up in this process
+        self.pid = None
+        self.thread = None
+
+    def start_thread(self): # Started on the first record, and again in a forked parser process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.max_queue)
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run, name='db-log', daemon=True)
+            self.thread.start()
 
     def emit(self, record):
         # Prepare the log entry for the database
@@ -46,10 +131,66 @@ class DatabaseLogHandler(logging.Handler):
             'message': record.getMessage(),
         }
 
-        # Insert the log entry into the database
-        with engine.connect() as conn:
-            conn.execute(insert(error_log_table).values(log_entry))
-            conn.commit()  # Ensure the transaction is committed
+        self.start_thread()
+        try:
+            self.queue.put_nowait(log_entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = self.flush_interval if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                log_entry = self.queue.get(timeout=timeout)
+                if log_entry is not None: # None only wakes the thread up on close()
+                    batch.append(log_entry)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            stopping = self.stopping.is_set()
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or stopping):
+                self.write_batch(batch)
+                batch = []
+                deadline = None
+            if stopping and self.queue.empty():
+                self.write_batch([])
+                return
+
+    def write_batch(self, batch):
+        rows = self.pending + batch
+        if error_log_table is None:
+            self.pending = rows[-self.max_queue:]
+            self.dropped += len(rows) - len(self.pending)
+            return
+        self.pending = []
+        if self.dropped:
+            rows.append({'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'level': 'WARNING',
+                         'message': f"{self.dropped} log records were not written to error_log, they are still in the text log."})
+        if not rows:
+            return
+
+        # Insert the log entries into the database
+        try:
+            with engine.connect() as conn:
+                conn.execute(insert(error_log_table), rows)
+                conn.commit()  # Ensure the transaction is committed
+            self.dropped = 0
+        except Exception:
+            self.dropped += len(rows) - (1 if self.dropped else 0)
+
+    def close(self): # Drain the queue before the process exits
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            self.stopping.set()
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+            self.thread.join(timeout=30)
+        super().close()
 
 def setup_logging():
     log_directory = "C:/data/script/system_data"
@@ -69,11 +210,10 @@ def setup_logging():
         handlers=[
             logging.FileHandler(log_filename),  # Log to a file
             logging.StreamHandler(),  # Also print to console
-            DatabaseLogHandler() 
-        ]
+        ]  # error_log is added by connect_databases()
     )
 
-def create_logging_tables_if_not_exists():
+def define_logging_tables():
     global etl_log_table, error_log_table 
     metadata = MetaData()
 
@@ -87,7 +227,12 @@ def create_logging_tables_if_not_exists():
         Column('test_file_name', String),
         Column('table_name', String),
         Column('rows_inserted', Integer),
-        Column('minutes_since_last_run', Integer)
+        Column('minutes_since_last_run', Integer),
+        *[Column(f'{stage}_seconds', Float) for stage in etl_log_stages],
+        Column('total_seconds', Float),
+        Column('bytes_read', BigInteger),
+        Column('source_file', String),
+        Column('source_file_id', BigInteger)
     )
 
     # Define schema for error_log table if needed
@@ -98,150 +243,676 @@ def create_logging_tables_if_not_exists():
         Column('message', String),
     )
 
-    # Create tables if they don’t exist
-    metadata.create_all(engine)
+    return metadata
+
+logging_tables_ready = False
+
+def create_logging_tables_if_not_exists(): # Returns False if the database is down, the rows are then queued on disk until it is back
+    global logging_tables_ready
+    connect_databases()
+    if logging_tables_ready:
+        return True
+    metadata = define_logging_tables()
+
+    try:
+        # Create tables if they don’t exist
+        metadata.create_all(engine)
+
+        with engine.begin() as conn: # etl_log tables made by older versions get the stage timing and source file columns
+            for column in etl_log_table.columns:
+                if column.name.endswith('_seconds') or column.name in ('bytes_read', 'source_file', 'source_file_id'):
+                    conn.execute(text(f'ALTER TABLE etl_log ADD COLUMN IF NOT EXISTS "{column.name}" {column.type.compile(dialect=engine.dialect)}'))
+        if coordinated():
+            create_coordination_tables()
+    except Exception as e:
+        logging.error(f"Could not set up etl_log and error_log, the database looks down, new rows are queued on disk: {str(e)[:900]}")
+        return False
+    logging_tables_ready = True
+    return True
 
 ########################################################## set up logging
 setup_logging() 
-########################################################## File modification times in OS
-# Load modification times from a text file
-def load_modification_times():
-    global file_mod_times
-    file_mod_times = {}
-    
+########################################################## Metrics
+# Time, rows, bytes and errors per stage, station and table since the process started. Written in the Prometheus text
+# format to METRICS_FILE after every pass (e.g. for the node_exporter textfile collector), and served on METRICS_PORT in daemon mode.
+metrics_file = os.getenv('METRICS_FILE')
+metrics_port = int(os.getenv('METRICS_PORT', 0))
+etl_log_stages = ['read', 'parse', 'insert_primary', 'insert_timescale', 'checkpoint'] # Saved per file in etl_log as <stage>_seconds
+
+class StageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {} # (stage, station, table) -> [calls, seconds, rows, bytes, errors]
+        self.passes = 0
+        self.last_pass_time = None
+
+    def record(self, stage, seconds, station_name=None, table_name=None, rows=0, byte_count=0, error=False):
+        with self.lock:
+            totals = self.stages.setdefault((stage, station_name or '', table_name or ''), [0, 0.0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += rows
+            totals[3] += byte_count
+            totals[4] += int(error)
+
+    def end_pass(self):
+        with self.lock:
+            self.passes += 1
+            self.last_pass_time = time.time()
+
+    def prometheus_text(self):
+        def label(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        series = [
+            ('etl_stage_calls_total', 'Times each ETL stage ran.', 0),
+            ('etl_stage_seconds_total', 'Time spent in each ETL stage.', 1),
+            ('etl_stage_rows_total', 'Rows handled by each ETL stage.', 2),
+            ('etl_stage_bytes_total', 'Bytes handled by each ETL stage.', 3),
+            ('etl_stage_errors_total', 'Failures in each ETL stage.', 4),
+        ]
+        lines = []
+        with self.lock:
+            for name, description, index in series:
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+                for (stage, station_name, table_name), totals in sorted(self.stages.items()):
+                    lines.append(f'{name}{{stage="{label(stage)}",station="{label(station_name)}",table="{label(table_name)}"}} {totals[index]}')
+            lines += ["# HELP etl_passes_total Scan and load passes finished.", "# TYPE etl_passes_total counter", f"etl_passes_total {self.passes}"]
+            if self.last_pass_time is not None:
+                lines += ["# HELP etl_last_pass_timestamp_seconds When the last pass finished.", "# TYPE etl_last_pass_timestamp_seconds gauge",
+                          f"etl_last_pass_timestamp_seconds {self.last_pass_time:.3f}"]
+        return "\n".join(lines) + "\n"
+
+metrics = StageMetrics()
+
+class FileTimings: # Stage durations for one file's etl_log row, every stage is also added to the process wide metrics
+    def __init__(self, station_name=None, table_name=None):
+        self.station_name = station_name
+        self.table_name = table_name
+        self.seconds = {}
+        self.bytes_read = 0
+        self.lock = threading.Lock() # The two database writes are timed from different threads
+
+    def record(self, stage, seconds, rows=0, byte_count=0, error=False):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            if stage == 'read':
+                self.bytes_read += byte_count
+        metrics.record(stage, seconds, self.station_name, self.table_name, rows, byte_count, error)
+
+    @contextmanager
+    def stage(self, stage): # Yields a dict the caller can put 'rows', 'bytes' and 'error' in
+        counts = {}
+        start = time.perf_counter()
+        try:
+            yield counts
+        except BaseException:
+            self.record(stage, time.perf_counter() - start, error=True)
+            raise
+        self.record(stage, time.perf_counter() - start, counts.get('rows', 0), counts.get('bytes', 0), counts.get('error', False))
+
+def metrics_text(): # Stage metrics, and the retry queue backlog as it is on disk right now
+    return metrics.prometheus_text() + (queue_metrics_text() if sinks else '')
+
+def write_metrics_file(): # Replaced in one go, so a collector never reads half a file
+    if metrics_file:
+        try:
+            with open(metrics_file + '.tmp', 'w') as f:
+                f.write(metrics_text())
+            os.replace(metrics_file + '.tmp', metrics_file)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {metrics_file}: {e}")
+
+def start_metrics_server(port): # GET /metrics on a background thread, for daemon mode
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # Scrapes are not worth a log line each
+            pass
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Serving metrics on port {port}.")
+    return server
+
+########################################################## ETL state
+# Run state lives in one SQLite database in WAL mode instead of mod_times.txt, last_lines.txt and etl_log_id.txt.
+# Each checkpoint is a one row transaction, so saving it costs the same however many files have ever been seen.
+state_db_file = os.getenv('STATE_DB', 'etl_state.db')
+state_db = None
+state_lock = threading.RLock() # One connection shared by the worker threads
+
+def open_state_store():
+    global state_db
+    with state_lock:
+        if state_db is None:
+            state_db = sqlite3.connect(state_db_file, check_same_thread=False, isolation_level=None) # Transactions are started explicitly
+            state_db.execute("PRAGMA journal_mode=WAL")
+            state_db.execute("PRAGMA synchronous=NORMAL")
+            state_db.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mod_time REAL, size INTEGER, inode INTEGER, head_hash TEXT,
+                line_count INTEGER, byte_offset INTEGER, context TEXT, etl_log_id INTEGER)""")
+            state_db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            state_db.execute("""CREATE TABLE IF NOT EXISTS backfill_files (
+                path TEXT PRIMARY KEY, line_count INTEGER, byte_offset INTEGER, context TEXT, etl_log_id INTEGER)""") # Kept apart from the normal checkpoints
+            migrate_text_state()
+        return state_db
+
+def close_state_store():
+    global state_db
+    with state_lock:
+        if state_db is not None:
+            state_db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            state_db.close()
+            state_db = None
+
+@contextmanager
+def state_transaction():
+    with state_lock:
+        db = open_state_store()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+def read_counter(name, default=None):
+    row = open_state_store().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else default
+
+def write_counter(db, name, value):
+    db.execute("INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name, value))
+
+def migrate_text_state(): # One time import of the text files older versions kept their state in
+    mod_times = {}
     if os.path.exists('mod_times.txt'):
         with open('mod_times.txt', 'r') as f:
             for line in f:
                 file_path, mod_time = line.strip().split("\t")
-                file_mod_times[file_path] = float(mod_time)
-        logging.info("Loaded previous file modification times.")
-    else:
-        logging.info("No previous modification times found, starting fresh.")
-
-
-# Save modification times to a text file
-def save_modification_times():
-    with open('mod_times.txt', 'w') as f:
-        for file_path, mod_time in file_mod_times.items():
-            f.write(f"{file_path}\t{mod_time}\n")
-    logging.info("File modification times saved.")
+                mod_times[file_path] = float(mod_time)
 
-def get_last_modification_time(file_path):
-    return os.path.getmtime(file_path)
+    checkpoints = {}
+    if os.path.exists('last_lines.txt'):
+        with open('last_lines.txt', 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t', 3)
+                byte_offset = int(parts[2]) if len(parts) > 2 and parts[2] else None # Older files only have the line count, the offset is worked out on first read
+                context = parts[3] if len(parts) > 3 and parts[3] else None
+                checkpoints[parts[0]] = (int(parts[1]), byte_offset, context)
+
+    etl_log_id = None
+    if os.path.exists('etl_log_id.txt'):
+        with open('etl_log_id.txt', 'r') as f:
+            etl_log_id = int(f.read())
+
+    if not mod_times and not checkpoints and etl_log_id is None:
+        return
+
+    with state_transaction() as db:
+        db.executemany("INSERT OR REPLACE INTO files (path, mod_time, line_count, byte_offset, context) VALUES (?, ?, ?, ?, ?)",
+                       [(path, mod_times.get(path), *checkpoints.get(path, (None, None, None))) for path in set(mod_times) | set(checkpoints)])
+        if etl_log_id is not None:
+            write_counter(db, 'next_etl_log_id', etl_log_id)
+        if os.path.exists('mod_times.txt') and os.path.exists('last_lines.txt'):
+            write_counter(db, 'initialized', 1)
+
+    for old_file in ('mod_times.txt', 'last_lines.txt', 'etl_log_id.txt'):
+        if os.path.exists(old_file):
+            os.replace(old_file, old_file + '.migrated')
+    logging.info(f"Migrated {len(mod_times)} mod times and {len(checkpoints)} last lines from the text files into {state_db_file}.")
+
+def is_first_run():
+    return not read_counter('initialized')
+
+# Load the file fingerprints from the state store
+def load_fingerprints():
+    global file_fingerprints
+    rows = open_state_store().execute("SELECT path, mod_time, size, inode, head_hash FROM files WHERE mod_time IS NOT NULL").fetchall()
+    file_fingerprints = {row[0]: row[1:] for row in rows}
+    logging.info(f"Loaded previous fingerprints for {len(file_fingerprints)} files.")
+    return file_fingerprints
+
+# Save the fingerprints of the given files only. Files that were truncated or replaced start again from the top.
+def save_fingerprints(fingerprints, restarted=()):
+    if fingerprints:
+        with state_transaction() as db:
+            db.executemany("""INSERT INTO files (path, mod_time, size, inode, head_hash) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET mod_time = excluded.mod_time, size = excluded.size,
+                inode = excluded.inode, head_hash = excluded.head_hash""",
+                           [(file_path, *fingerprint) for file_path, fingerprint in fingerprints.items()])
+            db.executemany("UPDATE files SET line_count = 0, byte_offset = 0, context = NULL WHERE path = ?",
+                           [(file_path,) for file_path in restarted])
+
+head_hash_bytes = 4096 # How much of the start of a file is hashed to tell an append from a different file
+
+def get_head_hash(file_path, length):
+    with open(file_path, 'rb') as f:
+        return hashlib.blake2b(f.read(min(length, head_hash_bytes)), digest_size=16).hexdigest()
+
+def classify_change(file_path, entry, known): # 'new', 'appended', 'truncated', 'replaced' or None when unchanged
+    stat = entry.stat() # Cached by scandir, no extra call on Windows
+    known_mod_time, known_size, known_inode, known_hash = known or (None, None, None, None)
+    if known is not None and stat.st_mtime == known_mod_time and (known_size is None or stat.st_size == known_size):
+        return None, known # Unchanged, the file is not opened
+
+    inode = entry.inode()
+    if known is None:
+        change = 'new'
+    elif known_size is not None and stat.st_size < known_size:
+        change = 'truncated'
+    elif known_hash is not None and known_size is not None and get_head_hash(file_path, known_size) != known_hash:
+        change = 'replaced' # Same name, different start, e.g. a test file saved over an old one
+    elif known_hash is None and known_inode is not None and inode != known_inode:
+        change = 'replaced'
+    else:
+        change = 'appended' # Also a copy that was saved back with the same start and a new inode
+    return change, (stat.st_mtime, stat.st_size, inode, get_head_hash(file_path, stat.st_size))
 
-def track_modified_files(log_file, directories):
-    modified_files = []
+def scan_directories(directories, fingerprints): # Check each directory for new or changed files, fingerprints is updated in place
+    changes = {} # path -> kind of change, in directory order
     valid_directories = 0  # Track how many valid directories are found
+    start_time = time.perf_counter()
 
-    last_mod_times = {} # Read the last recorded file mod times
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            for line in f:
-                filepath, last_mod_time = line.strip().split("\t")
-                last_mod_times[filepath] = float(last_mod_time)
-    
-    # Check each directory for modified files
     for directory in directories:
-        if os.path.exists(directory):  # Only process the directory if it exists
+        if directory and os.path.exists(directory):  # Only process the directory if it exists
             valid_directories += 1  # Count how many directories exist
-            for filename in os.listdir(directory):
-                file_path = os.path.join(directory, filename)
-                if os.path.isfile(file_path):
-                    current_mod_time = os.path.getmtime(file_path)
-
-                    # Check if it's a new or modified file
-                    if file_path not in last_mod_times or current_mod_time > last_mod_times[file_path]:
-                        modified_files.append(file_path)
-                        last_mod_times[file_path] = current_mod_time
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        file_path = os.path.join(directory, entry.name)
+                        try:
+                            change, fingerprint = classify_change(file_path, entry, fingerprints.get(file_path))
+                        except OSError as e: # Deleted or locked between the listing and the read, try again next scan
+                            logging.warning(f"Could not check {file_path}: {e}")
+                            continue
+                        if change:
+                            changes[file_path] = change
+                            fingerprints[file_path] = fingerprint
+                            if change in ('truncated', 'replaced'):
+                                logging.warning(f"{file_path} was {change}, loading it again from the first line.")
 
     # Raise an error if no valid directories were found
     if valid_directories == 0:
+        metrics.record('scan', time.perf_counter() - start_time, error=True)
         logging.critical("No valid directories found. Ensure that at least one folder exists.")
         raise FileNotFoundError("All specified directories are missing.")
 
-    # Write updated mod times back to the log file
-    with open(log_file, 'w') as f:
-        for filepath, mod_time in last_mod_times.items():
-            f.write(f"{filepath}\t{mod_time}\n")
-    
-    return modified_files
+    metrics.record('scan', time.perf_counter() - start_time, rows=len(changes)) # rows are the changed files here
+    return changes
+
+def restarted_files(changes):
+    return [file_path for file_path, change in changes.items() if change in ('truncated', 'replaced')]
+
+def save_changes(changes, fingerprints): # Store the new fingerprints and reset the checkpoints of truncated or replaced files
+    save_fingerprints({file_path: fingerprints[file_path] for file_path in changes}, restarted=restarted_files(changes))
+
+def mark_unfinished(file_path): # Loading stopped part way through, the next scan sees the file as changed and loads the rest
+    with state_transaction() as db:
+        db.execute("UPDATE files SET mod_time = 0 WHERE path = ?", (file_path,))
+    known = file_fingerprints.get(file_path)
+    if known is not None:
+        file_fingerprints[file_path] = (0, *known[1:])
+
+def track_modified_files(directories): # The changes are saved with save_changes() once they are about to be loaded
+    fingerprints = load_fingerprints() # Read the last recorded fingerprints
+    return scan_directories(directories, fingerprints)
+
+def count_lines_before_offset(file_path, offset): # helper to fill in the line count of a checkpoint that only has an offset
+    line_count = 0
+    with open(file_path, 'rb') as f:
+        while offset > 0:
+            chunk = f.read(min(offset, 1024**2))
+            if not chunk:
+                break
+            line_count += chunk.count(b'\n')
+            offset -= len(chunk)
+    return line_count
+
+def find_offset_of_line(file_path, line_number): # helper to turn an old line-count checkpoint into a byte offset
+    offset = 0
+    with open(file_path, 'rb') as f:
+        for i, raw_line in enumerate(f):
+            if i >= line_number:
+                break
+            offset += len(raw_line)
+    return offset
+
+def read_context_before_offset(file_path, offset): # Headers, station, test file name and parser state in force at offset, None if there are none
+    headers, table_name, station_name, test_file_name, header_timestamp = [], None, None, None, None
+    block_start_time = None
+    in_data_section = skip_units_row = False # Same rules as parse_lines: the line after the metadata is the headers row, then the units row
+    position = 0
+    with open(file_path, 'rb') as f:
+        for raw_line in f: # Only the metadata and header lines are decoded
+            if position >= offset:
+                break
+            position += len(raw_line)
+            if b"Data Header:" in raw_line or b"Station Name:" in raw_line or b"Test File Name:" in raw_line:
+                line = raw_line.decode(dat_file_encoding, errors='replace').strip()
+                if "Data Header:" in line:
+                    parts = line.split("\t")
+                    if len(parts) > 4:
+                        header_timestamp = datetime.strptime(parts[-1].strip(), "%m/%d/%Y %I:%M:%S %p").strftime("%Y-%m-%d %H:%M:%S")
+                    block_start_time = None
+                    continue
+                if "Station Name:" in line:
+                    station_name = line.split(":")[1].strip()
+                else:
+                    test_file_name = line.split(":")[1].strip()
+                in_data_section = False
+            elif not in_data_section:
+                headers = raw_line.decode(dat_file_encoding, errors='replace').strip().split("\t")
+                table_name = table_name_for_headers(headers)
+                in_data_section = skip_units_row = True
+                block_start_time = None
+            elif skip_units_row:
+                skip_units_row = False
+            elif block_start_time is None and 'Time' in headers: # Only the block's first row with a Time is decoded
+                cells = raw_line.decode(dat_file_encoding, errors='replace').strip().split("\t")
+                try:
+                    block_start_time = float(cells[headers.index('Time')])
+                except (IndexError, ValueError):
+                    pass
 
-def get_last_line_of_file(file_path): # helper to find the last line of a file.
-    with open(file_path, 'r') as f:
-        return sum(1 for _ in f)
+    if not headers or not table_name:
+        return None
+    state = {'most_recent_header_timestamp': header_timestamp, 'in_data_section': in_data_section, 'skip_units_row': skip_units_row, 'skip_block': False,
+             'block_start_time': block_start_time}
+    return {'headers': headers, 'table_name': table_name, 'station_name': station_name, 'test_file_name': test_file_name,
+            'header_tstamp_first': header_timestamp, 'state': state}
+
+def iter_file_lines(file_path, offset): # Complete lines from offset on, one at a time, used to look for the headers
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for raw_line in f:
+            if not raw_line.endswith(b'\n'): # A partially written last line is picked up next run
+                return
+            yield raw_line.decode(dat_file_encoding, errors='replace')
+
+def iter_line_batches(file_path, checkpoint): # Read the bytes appended since the checkpoint in batches of whole lines
+    line_number = checkpoint['line']
+    offset = checkpoint['offset']
+    carry = b''
+
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            new_bytes = f.read(batch_bytes)
+            if not new_bytes:
+                break
+            new_bytes = carry + new_bytes
+            end = new_bytes.rfind(b'\n') + 1 # Stop after the last complete line, the rest is carried into the next read
+            carry = new_bytes[end:]
+
+            raw_lines = new_bytes[:end].splitlines(keepends=True)
+            for i in range(0, len(raw_lines), batch_rows):
+                batch = b''.join(raw_lines[i:i + batch_rows])
+                first_line = line_number + 1
+                line_number += len(raw_lines[i:i + batch_rows])
+                offset += len(batch)
+                yield batch.decode(dat_file_encoding, errors='replace').splitlines(), first_line, {'line': line_number, 'offset': offset}
+
+    if carry:
+        logging.debug(f"Holding back {len(carry)} bytes of a partially written line in: {file_path}")
 
 ########################################################################################## Process each file in a loop
-# Process each modified file 
-def process_and_upload_files(modified_files, last_lines):
-    etl_log_file = 'etl_log_id.txt'  # Hardcoded the log file path
-    for input_file in modified_files:
-        logging.info(f"Starting processing for file: {input_file}")
-        try:        
-            if os.path.exists(input_file):             # Process the file
-                logging.info(f"File found: {input_file}")
-                with open(input_file, 'r') as infile:
-                    lines = infile.readlines()
-                    logging.info(f"Read {len(lines)} lines from the file: {input_file}")
-                
-                
-                last_line = read_last_processed_line(input_file, last_lines) # Read last processed line for this specific file
-                etl_log_id = read_etl_log_id(etl_log_file) # Read current etl_log_idn
-
-                df, last_processed_line, station_name, table_name, header_tstamp_first, test_file_name = process_data_file(lines, last_line, etl_log_id)  # Process the .dat file and convert to DataFrame
-
-                if table_name and not df.empty:
-                    success, rows_inserted = upload_to_database(df, table_name)
-                    if success:
-                        update_last_processed_line(input_file, last_processed_line, last_lines) # Update last processed line in memory
-                        logging.info(f"Successfully processed and uploaded data from: {input_file}")
-
-                        append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_name, table_name,rows_inserted)
-
-                etl_log_id += 1 # Increment etl_log_id for the next run and save it
-                save_etl_log_id(etl_log_file, etl_log_id)
-            else:
-                logging.error(f"File not found: {input_file}")
-        except Exception as e:
-            logging.error(f"Error processing {input_file}: {str(e)}")
-        logging.info(f"Finished processing file: {input_file}")
-######################################################################## Last line and logging
-def load_last_processed_lines(tsv_file='last_lines.txt'): #retrieves
-    last_lines = {}
-    if os.path.exists(tsv_file):
-        with open(tsv_file, 'r') as f:
-            for line in f:
-                filename, last_line = line.strip().split('\t')
-                last_lines[filename] = int(last_line)
-    return last_lines
-
-# Function to save the last processed lines to a tsv file
-def save_last_processed_lines(last_lines, tsv_file='last_lines.txt'):
-    with open(tsv_file, 'w') as f:
-        for filename, last_line in last_lines.items():
-            f.write(f"{filename}\t{last_line}\n")
-
-# Function to read the last processed line for a specific file
-def read_last_processed_line(input_file, last_lines):
-    if input_file in last_lines:
-        return last_lines[input_file]
+# Files are handled in parallel, a thread per file. Each file is streamed: read a batch of lines, parse it (in a process
+# pool when there is a lot of data), upload it, then commit the checkpoint, so memory stays flat however big the file is.
+# Reading and parsing run one stage ahead in a second thread per file (PIPELINE_DEPTH batches at most), so the next
+# batch is parsed while the database works on this one. Uploads and checkpoints stay in order in the file's thread.
+# etl_log_ids are handed out up front by the calling thread, checkpoints are committed one file at a time in the state store.
+parse_pool = None
+etl_log_file_lock = threading.Lock()
+
+def init_parse_worker(): # Parser processes get their own connection pools and the logging table definitions
+    if engine is None: # Spawned (Windows) rather than forked, nothing was inherited
+        connect_databases()
     else:
-        return 0  # Default to 0 if the file hasn't been processed before
-
-def update_last_processed_line(input_file, last_line, last_lines):
-    last_lines[input_file] = last_line
+        engine.dispose(close=False)
+        timescale_engine.dispose(close=False)
+        define_logging_tables()
+
+def get_parse_pool(): # Started on first use and reused, e.g. across daemon cycles
+    global parse_pool
+    if parse_pool is None:
+        parse_pool = ProcessPoolExecutor(max_workers=etl_workers, initializer=init_parse_worker)
+    return parse_pool
+
+def shutdown_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown()
+        parse_pool = None
+
+def timed_batches(batches, timings, offset): # The file is read inside the generator, so the read time is the time next() takes
+    while True:
+        with timings.stage('read') as counts:
+            batch = next(batches, None)
+            if batch is not None:
+                counts['rows'] = len(batch[0])
+                counts['bytes'] = batch[2]['offset'] - offset
+        if batch is None:
+            return
+        offset = batch[2]['offset']
+        yield batch
+
+def parse_batches(input_file, checkpoint, headers, state, etl_log_id, station_name, table_name, file_id, pool, timings):
+    # Read and parse the file batch by batch, yields each batch's rows (and their COPY text) with the checkpoint, headers and parser state after it
+    for lines, first_line, batch_checkpoint in timed_batches(iter_line_batches(input_file, checkpoint), timings, checkpoint['offset']):
+        logging.info(f"Read {len(lines)} new lines from the file: {input_file} (from line {first_line})")
+        with timings.stage('parse') as counts:
+            if pool is None:
+                df, state = parse_lines(lines, headers, state, etl_log_id, station_name, table_name, first_line, file_id)
+            else:
+                df, state = pool.submit(parse_lines, lines, headers, state, etl_log_id, station_name, table_name, first_line, file_id).result()
+            counts['rows'] = len(df)
+            # Rendered here, off the upload path and once for both databases
+            csv_text = copy_csv(df) if upload_method == 'copy' and not df.empty else None
+        headers = state.pop('headers') # A header block in this batch may have changed them
+        yield df, csv_text, batch_checkpoint, headers, state
+
+def prefetch(items, depth): # Run the items generator in its own thread, at most depth items ahead of the consumer
+    if depth <= 0:
+        yield from items
+        return
+
+    ready = queue.Queue(maxsize=depth) # Bounded, so a slow database holds the reader back instead of filling memory
+    stopping = threading.Event()
+    finished = object()
+
+    def put(entry): # Gives up once the consumer has stopped
+        while not stopping.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-def read_etl_log_id(log_file):
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            return int(f.read())
-    return 1  # Start from 1 if the file doesn't exist
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except BaseException as e: # Raised again in the consumer's thread
+            put((finished, e))
+        finally:
+            items.close()
+
+    thread = threading.Thread(target=produce, name=f"{threading.current_thread().name}-read", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally: # Also when the consumer breaks out early, e.g. a failed upload
+        stopping.set()
+        thread.join()
+
+def process_and_upload_file(input_file, checkpoint, etl_log_id, pool, minutes_since_last_run=None, checkpoint_table='files'):
+    logging.info(f"Starting processing for file: {input_file}")
+    start_time = time.perf_counter()
+    stopped_early = False
+    try:
+        if os.path.exists(input_file):             # Process the file
+            logging.info(f"File found: {input_file}")
+            if checkpoint['offset'] is None:
+                checkpoint = {'line': checkpoint['line'], 'offset': find_offset_of_line(input_file, checkpoint['line'])}
+            elif checkpoint['line'] is None: # Set up on a first run, which only records where the file ended
+                checkpoint = {'line': count_lines_before_offset(input_file, checkpoint['offset']), 'offset': checkpoint['offset']}
+            elif checkpoint['offset'] > os.path.getsize(input_file): # Shorter than when it was last read, and not caught by the scan
+                logging.warning(f"{input_file} is shorter than its checkpoint, loading it again from the first line.")
+                checkpoint = {'line': 0, 'offset': 0}
+
+            # A checkpoint carries the headers, table, station, test file name and parser state it was saved with, so appended
+            # rows are parsed straight away, new header blocks among them are checked by parse_lines. A checkpoint without
+            # them (first run, older versions) gets them once from the part of the file before it.
+            context = checkpoint.get('context')
+            if context is not None and 'block_start_time' not in context['state']: # Saved before 6.14, without the block's start time
+                context = None
+            if context is None and checkpoint['offset'] > 0:
+                context = read_context_before_offset(input_file, checkpoint['offset'])
+            if context is not None:
+                headers, header_tstamp_first, station_name, test_file_name, table_name = (
+                    context['headers'], context['header_tstamp_first'], context['station_name'], context['test_file_name'], context['table_name'])
+                state = context['state']
+            else: # Find the headers first, reading only as far as they are
+                headers, header_tstamp_first, station_name, test_file_name, table_name = extract_columns_and_metadata(iter_file_lines(input_file, checkpoint['offset']), 0)
+                state = new_parse_state()
+
+            if not headers or not table_name:
+                logging.error(f"{table_name}: No valid headers found in the file or unknown Table Type.")
+                return
+
+            timings = FileTimings(station_name, table_name)
+            file_id = source_file_id(input_file)
+            rows_inserted = 0
+            batches = parse_batches(input_file, checkpoint, headers, state, etl_log_id, station_name, table_name, file_id, pool, timings)
+            with closing(prefetch(batches, pipeline_depth)) as parsed_batches: # The next batches are read and parsed while this one uploads
+                for df, csv_text, batch_checkpoint, headers, state in parsed_batches:
+                    if df.empty: # Nothing to deliver, the checkpoint moves past these lines with the next batch that has rows
+                        continue
+                    success, batch_rows_inserted = upload_to_database(df, table_name, timings, csv_text)
+                    if not success:
+                        stopped_early = True
+                        break # Later batches must not get ahead of this one, the next run starts again from here
+                    batch_checkpoint['context'] = {'headers': headers, 'table_name': table_name, 'station_name': station_name,
+                                                   'test_file_name': test_file_name, 'header_tstamp_first': header_tstamp_first, 'state': state}
+                    with timings.stage('checkpoint'):
+                        checkpointed = update_last_processed_line(input_file, batch_checkpoint, etl_log_id, checkpoint_table) # Saved after every uploaded batch, so a crash resumes from the last one
+                    rows_inserted += batch_rows_inserted
+                    if not checkpointed: # The lease ran out and another host has the file now, it carries on from its own checkpoint
+                        logging.warning(f"{table_name}: Lost the lease on {input_file} to another worker, leaving the rest of the file to it.")
+                        stopped_early = True
+                        break
+                    if stop_requested.is_set(): # Ctrl+C or SIGTERM, the rest of the file is loaded next time from this checkpoint
+                        stopped_early = True
+                        break
+
+            if stopped_early and checkpoint_table == 'files':
+                mark_unfinished(input_file)
+
+            if rows_inserted:
+                logging.info(f"Successfully processed and uploaded data from: {input_file}")
+                timings.seconds['total'] = time.perf_counter() - start_time
+                append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_name, table_name, rows_inserted,
+                                   minutes_since_last_run, timings, input_file)
+        else:
+            logging.error(f"File not found: {input_file}")
+    except Exception as e:
+        logging.error(f"Error processing {input_file}: {str(e)}")
+    finally:
+        if coordinated() and checkpoint_table == 'files':
+            release_lease(input_file, finished=not stopped_early)
+        logging.info(f"Finished processing file: {input_file}")
 
-# Function to save the next etl_log_id
-def save_etl_log_id(log_file, etl_log_id):
-    with open(log_file, 'w') as f:
-        f.write(str(etl_log_id))
+# Process each modified file 
+def process_and_upload_files(modified_files, restarted=()): # restarted are the truncated or replaced files among them
+    if coordinated(): # Only the files no other host is loading, the ones it is are left to it
+        modified_files = claim_leases(modified_files)
+        reset_shared_checkpoints([f for f in modified_files if f in restarted])
+        if not modified_files:
+            return
+    etl_log_ids = reserve_etl_log_ids(len(modified_files)) # Hand out one etl_log_id per file up front, before any worker starts
+    minutes_since_last_run = start_load_run()
+
+    checkpoints = [read_last_processed_line(input_file) for input_file in modified_files] # Read last processed line and byte offset for each file
+
+    # Starting parser processes costs a few seconds, only worth it for several files with a lot of new data
+    new_bytes = sum(os.path.getsize(f) - (c['offset'] or 0) for f, c in zip(modified_files, checkpoints) if os.path.exists(f))
+    use_processes = etl_workers > 1 and len(modified_files) > 1 and new_bytes >= parse_process_min_bytes
+    pool = get_parse_pool() if use_processes else None
+
+    with ThreadPoolExecutor(max_workers=etl_workers, thread_name_prefix='file') as file_pool:
+        futures = [file_pool.submit(process_and_upload_file, input_file, checkpoint, etl_log_id, pool, minutes_since_last_run)
+                   for input_file, checkpoint, etl_log_id in zip(modified_files, checkpoints, etl_log_ids)]
+        for future in futures:
+            future.result()
+######################################################################## Last line and logging
+# Function to read the last processed line, byte offset and parser context for a specific file
+def read_last_processed_line(input_file, table='files'): # table is 'files' for normal runs, 'backfill_files' for backfill
+    row = None
+    if coordinated() and table == 'files': # A file no host has checkpointed yet starts from the local checkpoint, e.g. the end set on a first run
+        with engine.connect() as conn:
+            row = conn.execute(text("SELECT line_count, byte_offset, context FROM etl_checkpoints WHERE path = :path"),
+                               {'path': source_path(input_file)}).fetchone()
+    if row is None:
+        row = open_state_store().execute(f"SELECT line_count, byte_offset, context FROM {table} WHERE path = ?", (input_file,)).fetchone()
+    if row is None or (row[0] is None and row[1] is None):
+        return {'line': 0, 'offset': 0}  # Default to the start if the file hasn't been processed before
+
+    checkpoint = {'line': row[0], 'offset': row[1]}
+    if row[2]: # Headers and parser state when the checkpoint is part way through a data block
+        checkpoint['context'] = json.loads(row[2])
+    return checkpoint
+
+def update_last_processed_line(input_file, checkpoint, etl_log_id=None, table='files'): # False if this worker no longer holds the file's lease
+    context = json.dumps(checkpoint['context']) if checkpoint.get('context') else None
+    if coordinated() and table == 'files':
+        return update_shared_checkpoint(input_file, checkpoint, context, etl_log_id)
+    with state_transaction() as db:
+        db.execute(f"""INSERT INTO {table} (path, line_count, byte_offset, context, etl_log_id) VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT(path) DO UPDATE SET line_count = excluded.line_count, byte_offset = excluded.byte_offset,
+                       context = excluded.context, etl_log_id = COALESCE(excluded.etl_log_id, {table}.etl_log_id)""",
+                   (input_file, checkpoint['line'], checkpoint['offset'], context, etl_log_id))
+    return True
 
-def append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_name, table_name, rows_inserted):
+def reserve_etl_log_ids(count): # Returns count new etl_log_ids
+    if coordinated(): # From the shared sequence, so no two hosts hand out the same one
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT nextval('etl_log_id_seq') FROM generate_series(1, :count)"), {'count': count}).scalars().all()
+    with state_transaction() as db:
+        first_etl_log_id = read_counter('next_etl_log_id', 1)  # Start from 1 if nothing was saved yet
+        write_counter(db, 'next_etl_log_id', first_etl_log_id + count)
+    return list(range(first_etl_log_id, first_etl_log_id + count))
+
+def start_load_run(): # Remembers when this run started loading, returns the whole minutes since the previous one did
+    now = int(time.time())
+    with state_transaction() as db:
+        previous = read_counter('last_load_started_at')
+        write_counter(db, 'last_load_started_at', now)
+    return None if previous is None else (now - previous) // 60
+
+def append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_name, table_name, rows_inserted,
+                       minutes_since_last_run=None, timings=None, source_file=None):
     current_month_year = datetime.now().strftime("%Y_%m")
     log_directory = "C:/data/script/system_data"  
 
@@ -250,17 +921,12 @@ def append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_
 
     log_filename = os.path.join(log_directory, f"etl_log_{current_month_year}.txt")
 
-    # Check if the file exists
-    file_exists = os.path.exists(log_filename)
-
-    with open(log_filename, 'a') as log_file:
-        if not file_exists: # If the file doesn't exist, write the TSV header
+    with etl_log_file_lock, open(log_filename, 'a') as log_file: # Files are processed in parallel, one writer at a time
+        if log_file.tell() == 0: # If the file is new, write the TSV header
             log_file.write("id\tbegan_at_timestamp\theader_tstamp_first\tstation_name\ttest_file_name\ttable_name\trows_inserted\tminutes_since_last_run\n")
 
-        minutes_since_last_run = "NULL"
-
         timestamp_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")         # Append the log entry in TSV format, including the table_name
-        log_file.write(f"{etl_log_id}\t{timestamp_now}\t{header_tstamp_first}\t{station_name}\t{test_file_name}\t{table_name}\t{rows_inserted}\t{minutes_since_last_run}\n")
+        log_file.write(f"{etl_log_id}\t{timestamp_now}\t{header_tstamp_first}\t{station_name}\t{test_file_name}\t{table_name}\t{rows_inserted}\t{'NULL' if minutes_since_last_run is None else minutes_since_last_run}\n")
 
 
     current_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
@@ -272,14 +938,141 @@ def append_to_log_file(etl_log_id, header_tstamp_first, station_name, test_file_
         'test_file_name': test_file_name,
         'table_name': table_name,
         'rows_inserted': rows_inserted,
-        'minutes_since_last_run': None
+        'minutes_since_last_run': minutes_since_last_run
     }
+    if timings is not None: # How long each stage took for this file, to see where a slow run went
+        etl_log_entry.update({f'{stage}_seconds': timings.seconds.get(stage, 0.0) for stage in etl_log_stages})
+        etl_log_entry.update({'total_seconds': timings.seconds.get('total'), 'bytes_read': timings.bytes_read})
+    if source_file is not None: # Which file the rows' source_file_id stands for
+        etl_log_entry.update({'source_file': source_path(source_file), 'source_file_id': source_file_id(source_file)})
 
     # Insert the entry into the database
-    with engine.connect() as conn:
-        conn.execute(insert(etl_log_table).values(etl_log_entry))
-        conn.commit()
-        logging.info(f"Inserted log entry into etl_log with id: {etl_log_id}")
+    try:
+        with engine.connect() as conn:
+            conn.execute(insert(etl_log_table).values(etl_log_entry))
+            conn.commit()
+            logging.info(f"Inserted log entry into etl_log with id: {etl_log_id}")
+    except Exception as e: # The rows are already inserted or queued, the text log still has the entry
+        logging.error(f"Could not insert etl_log entry {etl_log_id}, it is only in the text log: {str(e)[:900]}")
+
+######################################################################## Coordination
+# With COORDINATION=postgres several hosts can watch the same shares. A host takes a lease on a file in etl_leases before
+# loading it, a heartbeat thread renews the lease while the file loads and it is deleted once the file is done. Checkpoints
+# are kept in etl_checkpoints and only saved while the lease is held, etl_log_ids come from the etl_log_id_seq sequence.
+# The leases of a host that dies run out after LEASE_SECONDS and another host carries on from the checkpoints, rows of
+# a batch that went in without its checkpoint are skipped by the source key index. Paths must be the same on every host.
+held_leases = set() # source_path of every file this process holds a lease on
+lease_lock = threading.Lock()
+heartbeat_thread = None
+
+def coordinated():
+    return coordination == 'postgres'
+
+def create_coordination_tables(): # The sequence starts after every etl_log_id used so far, by any host or by the local counter
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('etl_coordination_setup'))")) # Hosts starting together set up once
+        conn.execute(text("""CREATE TABLE IF NOT EXISTS etl_leases (
+            path TEXT PRIMARY KEY, worker TEXT NOT NULL, expires_at TIMESTAMPTZ NOT NULL)"""))
+        conn.execute(text("""CREATE TABLE IF NOT EXISTS etl_checkpoints (
+            path TEXT PRIMARY KEY, line_count BIGINT, byte_offset BIGINT, context TEXT, etl_log_id BIGINT,
+            updated_by TEXT, updated_at TIMESTAMPTZ DEFAULT now())"""))
+        if conn.execute(text("SELECT to_regclass('etl_log_id_seq')")).scalar() is None:
+            start = max(conn.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM etl_log")).scalar(), read_counter('next_etl_log_id', 1))
+            conn.execute(text(f"CREATE SEQUENCE etl_log_id_seq START {int(start)}"))
+
+def claim_leases(file_paths): # Returns the files this worker got, files leased by a live worker are left to it
+    paths = {source_path(file_path): file_path for file_path in file_paths}
+    try:
+        with engine.begin() as conn:
+            claimed = set(conn.execute(text("""INSERT INTO etl_leases (path, worker, expires_at)
+                SELECT path, :worker, now() + make_interval(secs => :seconds) FROM unnest(CAST(:paths AS TEXT[])) AS path
+                ON CONFLICT (path) DO UPDATE SET worker = excluded.worker, expires_at = excluded.expires_at
+                WHERE etl_leases.expires_at < now() OR etl_leases.worker = excluded.worker
+                RETURNING path"""), {'worker': worker_id, 'seconds': lease_seconds, 'paths': list(paths)}).scalars().all())
+    except Exception as e: # Nothing can be loaded without a lease, the files are looked at again on the next scan
+        logging.error(f"Could not claim leases, the database looks down: {str(e)[:900]}")
+        for file_path in file_paths:
+            mark_unfinished(file_path)
+        return []
+
+    with lease_lock:
+        held_leases.update(claimed)
+    start_heartbeat()
+    if len(claimed) < len(paths):
+        logging.info(f"{len(paths) - len(claimed)} changed files are being loaded by other workers, leaving them to them.")
+    return [file_path for path, file_path in paths.items() if path in claimed]
+
+def release_lease(file_path, finished=True): # A file left part way has its lease expire now instead, so the next scan of any host picks it up
+    path = source_path(file_path)
+    with lease_lock:
+        held_leases.discard(path)
+    try:
+        with engine.begin() as conn:
+            if finished:
+                conn.execute(text("DELETE FROM etl_leases WHERE path = :path AND worker = :worker"), {'path': path, 'worker': worker_id})
+            else:
+                conn.execute(text("UPDATE etl_leases SET expires_at = now() WHERE path = :path AND worker = :worker"), {'path': path, 'worker': worker_id})
+    except Exception as e:
+        logging.warning(f"Could not release the lease on {file_path}, it runs out by itself within {lease_seconds}s: {e}")
+
+def start_heartbeat():
+    global heartbeat_thread
+    with lease_lock:
+        if heartbeat_thread is None or not heartbeat_thread.is_alive():
+            heartbeat_thread = threading.Thread(target=renew_leases, name='lease-heartbeat', daemon=True)
+            heartbeat_thread.start()
+
+def renew_leases(): # Every third of the lease time, so one missed heartbeat does not lose a lease
+    while True:
+        time.sleep(lease_seconds / 3)
+        with lease_lock:
+            paths = list(held_leases)
+        if not paths:
+            continue
+        try:
+            with engine.begin() as conn:
+                renewed = set(conn.execute(text("""UPDATE etl_leases SET expires_at = now() + make_interval(secs => :seconds)
+                    WHERE worker = :worker AND path = ANY(CAST(:paths AS TEXT[])) RETURNING path"""),
+                    {'worker': worker_id, 'seconds': lease_seconds, 'paths': paths}).scalars().all())
+        except Exception as e:
+            logging.warning(f"Could not renew {len(paths)} leases: {str(e)[:900]}")
+            continue
+        lost = set(paths) - renewed
+        if lost: # Taken over after the heartbeat was late, the checkpoint of the next batch notices and stops the file
+            logging.warning(f"Lost the leases on {sorted(lost)} to other workers.")
+
+def update_shared_checkpoint(input_file, checkpoint, context, etl_log_id): # Only saved while this worker holds the lease
+    with engine.begin() as conn:
+        saved = conn.execute(text("""INSERT INTO etl_checkpoints (path, line_count, byte_offset, context, etl_log_id, updated_by, updated_at)
+            SELECT :path, :line, :offset, :context, :etl_log_id, :worker, now()
+            WHERE EXISTS (SELECT 1 FROM etl_leases WHERE path = :path AND worker = :worker FOR SHARE)
+            ON CONFLICT (path) DO UPDATE SET line_count = excluded.line_count, byte_offset = excluded.byte_offset, context = excluded.context,
+            etl_log_id = COALESCE(excluded.etl_log_id, etl_checkpoints.etl_log_id), updated_by = excluded.updated_by, updated_at = excluded.updated_at"""),
+            {'path': source_path(input_file), 'line': checkpoint['line'], 'offset': checkpoint['offset'], 'context': context,
+             'etl_log_id': etl_log_id, 'worker': worker_id}).rowcount
+    return saved == 1
+
+def reset_shared_checkpoints(file_paths): # Truncated or replaced files start again from the top on whichever host loads them
+    if file_paths:
+        with engine.begin() as conn:
+            conn.execute(text("""INSERT INTO etl_checkpoints (path, line_count, byte_offset, context, updated_by, updated_at)
+                SELECT path, 0, 0, NULL, :worker, now() FROM unnest(CAST(:paths AS TEXT[])) AS path
+                ON CONFLICT (path) DO UPDATE SET line_count = 0, byte_offset = 0, context = NULL,
+                updated_by = excluded.updated_by, updated_at = excluded.updated_at"""),
+                         {'worker': worker_id, 'paths': [source_path(f) for f in file_paths]})
+
+def add_abandoned_files(changes): # Files in our directories whose lease ran out before they were finished, e.g. the host loading them died
+    try:
+        with engine.connect() as conn:
+            expired = set(conn.execute(text("SELECT path FROM etl_leases WHERE expires_at < now()")).scalars().all())
+    except Exception as e: # They are still there on the next scan
+        logging.error(f"Could not look for abandoned files: {str(e)[:900]}")
+        return changes
+    if expired:
+        for file_path in file_fingerprints: # Every file the scans know about, by the same key the leases use
+            if source_path(file_path) in expired and file_path not in changes:
+                changes[file_path] = 'abandoned'
+    return changes
 
 #########################################################################
 
@@ -294,8 +1087,8 @@ def extract_columns_and_metadata(lines, last_line_processed):
     table_name = None
 
     try:
-        for i in range(last_line_processed, len(lines)): # Start from the last processed line
-            line = lines[i].strip()
+        for line in itertools.islice(lines, last_line_processed, None): # Start from the last processed line, lines can also be a generator
+            line = line.strip()
 
             if "Data Header:" in line: # Extract the timestamp from the latest Data Header
                 parts = line.split("\t")
@@ -314,14 +1107,8 @@ def extract_columns_and_metadata(lines, last_line_processed):
             if found_test_file and not headers:
                 headers = line.split("\t")  # Use the next line as headers
 
-                # Determine table name based on unique headers
-                if "Ch 1 Output" in headers:
-                    table_name = "table_top"
-                elif "Rotary Output" in headers:
-                    table_name = "rotary"
-                elif "Axial Output" in headers:
-                    table_name = "mts_810"
-                else:
+                table_name = table_name_for_headers(headers)
+                if table_name is None:
                     raise ValueError("Unknown table type based on headers")
 
                 break  # We have found the headers, stop searching
@@ -336,91 +1123,193 @@ def extract_columns_and_metadata(lines, last_line_processed):
     
     return headers, header_tstamp_first, station_name, test_file_name, table_name
 
-def process_data_file(lines, last_line_processed, etl_log_id):
-    data = []
-    most_recent_header_timestamp = None  # Track the most recent timestamp
-    
-    headers, header_tstamp_first, station_name, test_file_name, table_name = extract_columns_and_metadata(lines, last_line_processed)
-
-    if not headers or not table_name:
-        logging.error(f"{table_name}: No valid headers found in the file or unknown Table Type.")
-        return pd.DataFrame(), last_line_processed, station_name, None
-
-    in_data_section = False  # Track whether we are in the data section
-    skip_units_row = False  # Set a flag to skip the units row
-
-    for i in range(last_line_processed, len(lines)):
-        line = lines[i].strip()
-
+def table_name_for_headers(headers): # Determine table name based on unique headers, None if none of them is there
+    if "Ch 1 Output" in headers:
+        return "table_top"
+    elif "Rotary Output" in headers:
+        return "rotary"
+    elif "Axial Output" in headers:
+        return "mts_810"
+    return None
+
+def parse_data_block(block_lines, headers, first_line_number, table_name): # Convert a whole block of tab separated data rows to floats in one go, with their line numbers
+    expected_tabs = len(headers) - 1
+    stripped = [line.strip() for line in block_lines]
+    positions = [i for i, line in enumerate(stripped) if line.count('\t') == expected_tabs] # Rows whose column count does not match the headers are dropped
+    if not positions:
+        return np.empty((0, len(headers))), np.empty(0, dtype=np.int64)
+    matching = [stripped[i] for i in positions]
+    line_numbers = first_line_number + np.array(positions, dtype=np.int64)
+
+    try: # Fast path, the whole block is numeric
+        return pd.read_csv(io.StringIO('\n'.join(matching)), sep='\t', header=None, dtype=np.float64, quoting=csv.QUOTE_NONE,
+                           keep_default_na=False, na_values=['nan', 'NaN'], skip_blank_lines=False).to_numpy(), line_numbers
+    except ValueError:
+        pass
+
+    # Slow path, find and drop the rows with a non-numeric cell
+    cells = pd.Series(matching, index=positions).str.split('\t', expand=True)
+    values = cells.apply(pd.to_numeric, errors='coerce')
+    nan_literals = cells.apply(lambda col: col.str.strip().str.lower().isin(['nan', '+nan', '-nan']))
+    bad_rows = (values.isna() & ~nan_literals).any(axis=1)
+    for position in values.index[bad_rows]:
+        logging.error(f"{table_name}: Skipping line {first_line_number + position} due to ValueError: non-numeric value in row")
+    return values[~bad_rows].to_numpy(dtype=np.float64), line_numbers[~bad_rows.to_numpy()]
+
+def new_parse_state(): # What parse_lines needs to carry from one batch of lines to the next
+    return {'most_recent_header_timestamp': None, 'in_data_section': False, 'skip_units_row': False, 'skip_block': False,
+            'block_start_time': None} # Time of the first row of the open block
+
+def first_time(values, headers): # First Time value of a block of rows, None if the block has none
+    if 'Time' not in headers:
+        return None
+    times = values[:, headers.index('Time')]
+    times = times[~np.isnan(times)]
+    return float(times[0]) if len(times) else None
+
+def parse_lines(lines, headers, state, etl_log_id, station_name, table_name, first_line_number=1, source_file_id=None): # Returns the rows as a DataFrame and the state for the next batch
+    most_recent_header_timestamp = state['most_recent_header_timestamp']  # Track the most recent timestamp
+    in_data_section = state['in_data_section']  # Track whether we are in the data section
+    skip_units_row = state['skip_units_row']  # Set a flag to skip the units row
+    skip_block = state.get('skip_block', False)  # The open block's headers are for another table
+    block_start_time = state.get('block_start_time')  # Time of the open block's first row, it may have been in an earlier batch
+
+    # Only the metadata lines are looked at one by one, the data rows between them are sliced out and parsed as blocks
+    metadata_lines = [i for i, line in enumerate(lines)
+                      if "Data Header:" in line or "Station Name:" in line or "Test File Name:" in line]
+    metadata_lines.append(len(lines))
+
+    blocks = []
+    block_headers = []
+    line_blocks = []
+    block_timestamps = []
+    block_start_times = []
+    start = 0
+
+    for end in metadata_lines:
+        if start < end and not in_data_section:  # The first line after the metadata is the headers row
+            in_data_section = True
+            skip_units_row = True  # We know the next line will be the units row, so we skip it
+            new_headers = lines[start].strip().split("\t")
+            new_table_name = table_name_for_headers(new_headers) # None if it is not a header row we know, the headers stay as they were
+            skip_block = False
+            block_start_time = None
+            if new_headers != headers and new_table_name is not None: # Check the new header block against the headers the file was being read with
+                if new_table_name == table_name:
+                    logging.info(f"{table_name}: The headers changed at line {first_line_number + start}, now {new_headers}.")
+                    headers = new_headers
+                else:
+                    logging.error(f"{table_name}: The headers at line {first_line_number + start} are not for {table_name}, skipping that block: {new_headers}")
+                    skip_block = True
+            start += 1
+
+        if start < end and skip_units_row:  # Skip the units line after the headers - We are assuming that units is always after the headers
+            skip_units_row = False
+            start += 1
+
+        if start < end and not skip_block:
+            values, line_numbers = parse_data_block(lines[start:end], headers, first_line_number + start, table_name)
+            blocks.append(values)
+            block_headers.append(headers)
+            line_blocks.append(line_numbers)
+            block_timestamps.append((most_recent_header_timestamp, len(values)))
+            if block_start_time is None:
+                block_start_time = first_time(values, headers)
+            block_start_times.append(block_start_time)
+
+        if end == len(lines):
+            break
+
+        line = lines[end].strip()
         if "Data Header:" in line: # Handle the most recent Data Header timestamp
             parts = line.split("\t")
             if len(parts) > 4:
                 timestamp_from_file = parts[-1].strip()             # Extract the timestamp from the header and convert to SQL format
                 parsed_timestamp = datetime.strptime(timestamp_from_file, "%m/%d/%Y %I:%M:%S %p")
                 most_recent_header_timestamp = parsed_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-            continue  # Continue to the next line, we're still processing metadata
-
-        if "Station Name:" in line or "Test File Name:" in line:
-            in_data_section = False  # Still in metadata
-            continue
-
-        if headers and not in_data_section:  # Start processing data after headers
-            in_data_section = True
-            skip_units_row = True  # We know the next line will be the units row, so we skip it
-            continue
+            block_start_time = None # The rows that follow are a new block, even without a headers row of their own
+        else:
+            in_data_section = False  # Station Name / Test File Name, still in metadata
+        start = end + 1
+
+    if all(columns is headers for columns in block_headers): # Usual case, one set of headers for the whole batch
+        values = np.vstack(blocks) if blocks else np.empty((0, len(headers)))
+        df = pd.DataFrame(values, columns=headers)
+    else: # Columns a block does not have are left empty
+        df = pd.concat([pd.DataFrame(values, columns=columns) for values, columns in zip(blocks, block_headers)], ignore_index=True)
+
+    # Add 4 extra columns for etl_log_id, header_timestamp, sample_timestamp and station_name, the constant ones are broadcast
+    block_counts = [count for _, count in block_timestamps]
+    df.insert(0, 'etl_log_id', etl_log_id)
+    df.insert(1, 'header_timestamp', np.repeat(np.array([ts for ts, _ in block_timestamps], dtype=object), block_counts))
+    df.insert(2, 'sample_timestamp', sample_timestamps(df, block_timestamps, block_counts, block_start_times))
+    df.insert(3, 'station_name', station_name)
+    if source_file_id is not None: # Source key, the same row of the same file always gets the same key, so loading it again is skipped
+        df.insert(4, 'source_file_id', source_file_id)
+        df.insert(5, 'source_line', np.concatenate(line_blocks) if line_blocks else np.empty(0, dtype=np.int64))
+
+    state = {'most_recent_header_timestamp': most_recent_header_timestamp, 'in_data_section': in_data_section, 'skip_units_row': skip_units_row,
+             'skip_block': skip_block, 'block_start_time': block_start_time, 'headers': headers} # headers is taken out again by the caller, it is saved in the checkpoint on its own
+    return df, state
+
+def sample_timestamps(df, block_timestamps, block_counts, block_start_times):
+    # Data Header time plus the seconds since the block's first row, to the microsecond. Time is the running test time, it
+    # does not start again at 0 in each block, so the time the block started at is taken off.
+    header_times = np.repeat(np.array([np.datetime64(ts) if ts else np.datetime64('NaT') for ts, _ in block_timestamps],
+                                      dtype='datetime64[us]'), block_counts)
+    if 'Time' not in df.columns:
+        return header_times
+    start_times = np.repeat(np.array([np.nan if t is None else t for t in block_start_times], dtype=np.float64), block_counts)
+    elapsed = np.nan_to_num(df['Time'].to_numpy(dtype=np.float64) - start_times) # A missing Time falls back to the header time
+    return header_times + np.round(elapsed * 1e6).astype(np.int64).astype('timedelta64[us]')
+
+def source_path(file_path): # Absolute, with forward slashes (and lower case on Windows), so the key does not depend on the working directory
+    return os.path.normcase(os.path.abspath(file_path)).replace('\\', '/')
+
+def source_file_id(file_path): # 63 bit hash of the path, a number is much cheaper to store and COPY on every row than the path itself
+    return int.from_bytes(hashlib.blake2b(source_path(file_path).encode('utf-8'), digest_size=8).digest(), 'big') >> 1
+
+def process_data_file(lines, last_line_processed, etl_log_id): # Parse a whole list of lines in one go
+    headers, header_tstamp_first, station_name, test_file_name, table_name = extract_columns_and_metadata(lines, last_line_processed)
 
-        if skip_units_row:         # Skip the units line after the headers - We are assuming that units is always after the headers
-            skip_units_row = False  # Reset the flag after skipping
-            continue
+    if not headers or not table_name:
+        logging.error(f"{table_name}: No valid headers found in the file or unknown Table Type.")
+        return pd.DataFrame(), last_line_processed, station_name, None, header_tstamp_first, test_file_name
 
-        if in_data_section:
-            columns = line.split("\t")  # Split using tab between columns
+    df, _ = parse_lines(lines[last_line_processed:], headers, new_parse_state(), etl_log_id, station_name, table_name, last_line_processed + 1)
+    return df, len(lines), station_name, table_name, header_tstamp_first, test_file_name
 
-            if len(columns) == len(headers):             # Ensure the number of columns matches the headers before adding the extra columns
-                try:
-                    row_data = [float(c) for c in columns] # Convert the data to appropriate types - assuming they are of type floats
-                    
-                    row_data.insert(0, etl_log_id)  # Insert etl_log_id as first column
-                    row_data.insert(1, most_recent_header_timestamp)  # Insert most recent header timestamp as second column
-                    row_data.insert(2, station_name)     
-                    
-                    data.append(row_data)
-                except ValueError as ve:
-                    logging.error(f"{table_name}: Skipping line {i + 1} due to ValueError: {ve}")
-    
-    headers = ['etl_log_id', 'header_timestamp', 'station_name'] + headers      # Add 3 extra headers for the new columns: etl_log_id, header_timestamp
-    df = pd.DataFrame(data, columns=headers)
 
-    return df, len(lines), station_name, table_name, header_tstamp_first, test_file_name
+def column_type(col):
+    if col in ("header_timestamp", "sample_timestamp", "window_start", "last_sample_timestamp"):
+        return TIMESTAMP
+    elif col in ("etl_log_id", "sample_count", "source_file_id", "source_line"):
+        return BigInteger
+    elif col == "station_name":
+        return String
+    return Float  # Assume float for other columns
 
+start_values = { # Hardcoded start values for sequences, the _ts tables use the same ones
+    'table_top': 1,
+    'rotary': 2 * 10**18, # 2 quintillion
+    'mts_810': 3 * 10**18, # 3 quintillion
+    'placeholder': 4 * 10**18 # 4 quintillion
+}
 
 def create_table_if_not_exists(engine, table_name, df):
     metadata = MetaData()
 
-    columns = [Column('id', BigInteger, primary_key=True)] # Define dynamic columns based on DataFrame
+    # Not a BIGSERIAL, that would come with its own <table>_id_seq starting at 1 and the start value below would never be used
+    columns = [Column('id', BigInteger, primary_key=True, autoincrement=False)] # Define dynamic columns based on DataFrame
     for col in df.columns:
         if col not in ['id']:
-            if col == "header_timestamp":
-                columns.append(Column(col, TIMESTAMP))
-            elif col == "etl_log_id":
-                columns.append(Column(col, BigInteger))
-            elif col == "station_name":
-                columns.append(Column(col, String))
-            else:
-                columns.append(Column(col, Float))  # Assume float for other columns
+            columns.append(Column(col, column_type(col)))
 
     try:
         table = Table(table_name, metadata, *columns) # Step 1: Create the table if it does not exist
         metadata.create_all(engine)
 
-        start_values = { # Hardcoded start values for sequences
-            'table_top': 1,
-            'rotary': 2 * 10**18, # 2 quintillion
-            'mts_810': 3 * 10**18, # 3 quintillion
-            'placeholder': 4 * 10**18 # 4 quintillion
-        }
-
-        start_value = start_values.get(table_name, 1)
+        start_value = start_values.get(table_name.removesuffix('_ts'), 1)
         sequence_name = f"{table_name}_id_seq"
 
         with engine.connect() as conn:
@@ -437,6 +1326,7 @@ def create_table_if_not_exists(engine, table_name, df):
 
             try:  # Attach the sequence to the id column, but only if it's not already attached
                 conn.execute(text(f"ALTER TABLE \"{table_name}\" ALTER COLUMN id SET DEFAULT nextval('{sequence_name}');"))
+                conn.commit()
             except Exception as e:
                 logging.error(f"Error attaching sequence to id column for {table_name}: {str(e)}")
 
@@ -448,104 +1338,993 @@ def create_table_if_not_exists(engine, table_name, df):
 
     return True
 
-##### Temporary placeholder function to insert into timescale database.
+##### TimescaleDB tables: the same table as in the primary database, then made a hypertable if the extension is available
 def create_table_if_not_exists_ts(engine, table_name, df):
-    metadata = MetaData()
-
-    columns = [Column('id', BigInteger, primary_key=True)] # Define dynamic columns based on DataFrame
-    for col in df.columns:
-        if col not in ['id']:
-            if col == "header_timestamp":
-                columns.append(Column(col, TIMESTAMP))
-            elif col == "etl_log_id":
-                columns.append(Column(col, BigInteger))
-            elif col == "station_name":
-                columns.append(Column(col, String))
-            else:
-                columns.append(Column(col, Float))  # Assume float for other columns
+    if not create_table_if_not_exists(engine, table_name, df):
+        return False
 
     try:
-        table = Table(table_name, metadata, *columns) # Step 1: Create the table if it does not exist
-        metadata.create_all(engine)
+        setup_hypertable(engine, table_name)
+    except Exception as e: # The plain table still takes the rows
+        logging.error(f"{table_name}: Could not set up the hypertable, keeping a plain table: {str(e)[:900]}")
+    return True
 
-        start_values = { # Hardcoded start values for sequences
-            'table_top': 1,
-            'rotary': 2 * 10**18, # 2 quintillion
-            'mts_810': 3 * 10**18, # 3 quintillion
-            'placeholder': 4 * 10**18 # 4 quintillion
-        }
+timescale_available = {} # engine -> whether the timescaledb extension could be loaded
+hypertables = set() # (engine, table name) of tables that are hypertables, their time column is NOT NULL
+time_indexed_tables = set() # (engine, table name) of _ts tables left plain without the extension, ensure_table_ready indexes their time column
+hypertables_lock = threading.Lock()
 
-        start_value = start_values.get(table_name, 1)
-        sequence_name = f"{table_name}_id_seq"
+extension_missing_codes = ('58P01', '42704') # undefined_file (no control file, PostgreSQL 14 and older) and undefined_object, psycopg2 raises the first as an OperationalError
 
-        with engine.connect() as conn:
-            sequence_check_query = f"SELECT 1 FROM pg_class WHERE relname = '{sequence_name}' AND relkind = 'S'" # Check if sequence exists
-            sequence_exists = conn.execute(text(sequence_check_query)).fetchone()
+def timescale_enabled(engine):
+    with hypertables_lock:
+        if engine not in timescale_available:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text("CREATE EXTENSION IF NOT EXISTS timescaledb"))
+                timescale_available[engine] = True
+            except Exception as e:
+                if isinstance(e, OperationalError) and getattr(e.orig, 'pgcode', None) not in extension_missing_codes: # Could not connect, ask again next time
+                    raise
+                logging.warning(f"TimescaleDB is not available in {engine.url.database}, _ts tables stay plain tables: {str(e).splitlines()[0]}")
+                timescale_available[engine] = False
+        return timescale_available[engine]
+
+def setup_hypertable(engine, table_name, convert=False): # convert also turns a plain _ts table that has rows into a hypertable, moving them into chunks
+    column = timescale_time_column
+    if not timescale_enabled(engine):
+        with hypertables_lock: # Without the extension, an index at least keeps time range queries off full scans
+            time_indexed_tables.add((engine, table_name))
+        return
+
+    with engine.begin() as conn:
+        hypertable = conn.execute(text("SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = :table_name"),
+                                  {'table_name': table_name}).fetchone()
+        if hypertable is None and not convert and conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{table_name}")')).scalar():
+            # Moving the rows takes as long as copying the table, that is left to the hypertable command
+            logging.warning(f"{table_name}: Still a plain table, run `python etl_mts_771.py hypertable` to move its rows into chunks.")
+            return
+        if hypertable is None:
+            logging.info(f"{table_name}: Converting to a hypertable on {column} with {timescale_chunk_interval} chunks.")
+            # Unique indexes on a hypertable must include the time column, so the id primary key goes, the id default stays
+            conn.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT IF EXISTS "{table_name}_pkey"'))
+            conn.execute(text("SELECT create_hypertable(CAST(:table_name AS regclass), :column, chunk_time_interval => CAST(:chunk_interval AS INTERVAL), "
+                              "migrate_data => true, if_not_exists => true)"),
+                         {'table_name': f'"{table_name}"', 'column': column, 'chunk_interval': timescale_chunk_interval})
+        else:
+            conn.execute(text("SELECT set_chunk_time_interval(CAST(:table_name AS regclass), CAST(:chunk_interval AS INTERVAL))"),
+                         {'table_name': f'"{table_name}"', 'chunk_interval': timescale_chunk_interval}) # Applies to new chunks
+
+        if timescale_compress_after:
+            if not (hypertable and hypertable[0]):
+                conn.execute(text(f"ALTER TABLE \"{table_name}\" SET (timescaledb.compress, timescaledb.compress_segmentby = 'station_name', "
+                                  f"timescaledb.compress_orderby = '{column} DESC')"))
+            conn.execute(text("SELECT add_compression_policy(CAST(:table_name AS regclass), CAST(:compress_after AS INTERVAL), if_not_exists => true)"),
+                         {'table_name': f'"{table_name}"', 'compress_after': timescale_compress_after})
+        if timescale_retention:
+            conn.execute(text("SELECT add_retention_policy(CAST(:table_name AS regclass), CAST(:retention AS INTERVAL), if_not_exists => true)"),
+                         {'table_name': f'"{table_name}"', 'retention': timescale_retention})
+
+    with hypertables_lock:
+        hypertables.add((engine, table_name))
+    logging.info(f"{table_name}: Hypertable ready (compress after {timescale_compress_after or 'never'}, retention {timescale_retention or 'none'}).")
+
+########################################################################################## Partitioned primary tables
+# With PRIMARY_PARTITIONING the primary tables are declaratively partitioned by header_timestamp month, <table>_YYYY_MM,
+# with 'month,station' each month is hash partitioned on station_name again. Months are created PARTITION_MONTHS_AHEAD
+# ahead and whenever a batch has rows for a month that has no partition yet, rows without a header_timestamp go to
+# <table>_default. Unique indexes on a partitioned table need the partition columns, so like on the hypertables there is
+# no id primary key, the id default stays. A BRIN index on header_timestamp stays small on time ordered rows. Moving the
+# rows of an existing plain table takes as long as copying it, so it is only done by the partition command.
+partitioned_tables = set() # (engine, table name) of the partitioned primary tables
+partition_months = {} # (engine, table name) -> month starts that have a partition
+partitions_lock = threading.Lock()
+
+def create_table_if_not_exists_primary(engine, table_name, df):
+    if not primary_partitioning:
+        return create_table_if_not_exists(engine, table_name, df)
+    try:
+        if table_kind(engine, table_name) == 'r':
+            logging.warning(f"{table_name}: Still a plain table, run `python etl_mts_771.py partition` to move its rows into monthly partitions.")
+            return create_table_if_not_exists(engine, table_name, df)
+        setup_partitioned_table(engine, table_name, df)
+    except Exception as e: # Nothing was changed, the plain table keeps taking the rows
+        logging.error(f"{table_name}: Could not set up the partitioned table, keeping a plain table: {str(e)[:900]}")
+        return create_table_if_not_exists(engine, table_name, df)
+    return True
 
-            if not sequence_exists:
-                logging.info(f"Creating sequence: {sequence_name}")
-                conn.execute(text(f"CREATE SEQUENCE {sequence_name} START WITH {start_value};"))
+def partition_key_columns(engine, table_name):
+    if (engine, table_name) not in partitioned_tables:
+        return []
+    return ['header_timestamp', 'station_name'] if 'station' in primary_partitioning else ['header_timestamp']
+
+def month_starts(timestamps): # First day of every month in the column, missing times have no month
+    return {datetime(t.year, t.month, 1) for t in pd.to_datetime(timestamps.dropna().unique())}
+
+def table_kind(engine, table_name): # 'r' for a plain table, 'p' for a partitioned one, None if there is no such table
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)"), {'table_name': f'"{table_name}"'}).scalar()
+
+def table_definition(conn, table_name): # Column names and types as the database has them
+    return conn.execute(text("""SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(:table_name) AND attnum > 0 AND NOT attisdropped ORDER BY attnum"""),
+                        {'table_name': f'"{table_name}"'}).fetchall()
+
+def setup_partitioned_table(engine, table_name, df=None, migrate=False): # migrate moves the rows of an existing plain table into partitions
+    sequence_name = f"{table_name}_id_seq"
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {'key': f'partition {table_name}'}) # Other workers and hosts wait
+        kind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)"), {'table_name': f'"{table_name}"'}).scalar()
+        months = set()
+        if kind == 'r' and not migrate:
+            raise RuntimeError("it is a plain table, the partition command moves its rows")
+        if kind != 'p':
+            # An existing sequence keeps counting where it is, a new one starts at the table's start value
+            conn.execute(text(f'CREATE SEQUENCE IF NOT EXISTS "{sequence_name}" START WITH {start_values.get(table_name, 1)}'))
+            if kind is None:
+                columns = [(col, column_type(col)().compile(dialect=engine.dialect)) for col in df.columns if col != 'id']
             else:
-                logging.info(f"Sequence {sequence_name} already exists, not restarting.")
+                logging.info(f"{table_name}: Moving the rows into a table partitioned by header_timestamp month ({primary_partitioning}).")
+                old_table = f"{table_name}_unpartitioned"
+                conn.execute(text(f'ALTER TABLE "{table_name}" RENAME TO "{old_table}"'))
+                conn.execute(text(f'ALTER SEQUENCE "{sequence_name}" OWNED BY NONE')) # The BIGSERIAL sequence would go with the old table
+                columns = [(col, sql_type) for col, sql_type in table_definition(conn, old_table) if col != 'id']
+                months = {m for (m,) in conn.execute(text(f'SELECT DISTINCT date_trunc(\'month\', header_timestamp) FROM "{old_table}" WHERE header_timestamp IS NOT NULL'))}
+
+            column_list = ', '.join(f'"{col}" {sql_type}' for col, sql_type in columns)
+            conn.execute(text(f'CREATE TABLE "{table_name}" (id BIGINT NOT NULL DEFAULT nextval(\'"{sequence_name}"\'), {column_list}) '
+                              f'PARTITION BY RANGE (header_timestamp)'))
+            conn.execute(text(f'ALTER SEQUENCE "{sequence_name}" OWNED BY "{table_name}".id'))
+            conn.execute(text(f'CREATE TABLE "{table_name}_default" PARTITION OF "{table_name}" DEFAULT'))
+
+        month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(partition_months_ahead + 1): # This month and the ones ahead
+            months.add(month)
+            month = next_month(month)
+        for month in sorted(months):
+            create_month_partition(conn, table_name, month)
+
+        if kind == 'r':
+            names = ', '.join(['id'] + [f'"{col}"' for col, _ in columns])
+            start_time = time.perf_counter()
+            moved = conn.execute(text(f'INSERT INTO "{table_name}" ({names}) SELECT {names} FROM "{table_name}_unpartitioned"')).rowcount
+            conn.execute(text(f'DROP TABLE "{table_name}_unpartitioned"'))
+            logging.info(f"{table_name}: Moved {moved} rows into {len(months)} monthly partitions in {time.perf_counter() - start_time:.1f}s.")
+
+        # Built after the rows are in, the sample_timestamp and source key indexes follow in ensure_table_ready or run_partition
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_header_timestamp_brin_idx" ON "{table_name}" USING BRIN (header_timestamp)'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_etl_log_id_idx" ON "{table_name}" (etl_log_id)'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_station_name_idx" ON "{table_name}" (station_name, header_timestamp)'))
+
+    with partitions_lock:
+        partitioned_tables.add((engine, table_name))
+        partition_months.setdefault((engine, table_name), set()).update(months)
+    logging.info(f"{table_name}: Partitioned table ready ({primary_partitioning}, {partition_months_ahead} months ahead).")
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+def create_month_partition(conn, table_name, month): # Does nothing if the month has a partition already
+    partition = f"{table_name}_{month:%Y_%m}"
+    by_station = 'station' in primary_partitioning
+    conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{partition}" PARTITION OF "{table_name}" '
+                      f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+                      f"{' PARTITION BY HASH (station_name)' if by_station else ''}"))
+    if by_station:
+        for remainder in range(station_partitions):
+            conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{partition}_s{remainder}" PARTITION OF "{partition}" '
+                              f'FOR VALUES WITH (MODULUS {station_partitions}, REMAINDER {remainder})'))
+
+def create_month_partitions(engine, table_name, months): # Months a batch has rows for, only the ones this process has not made yet cost a round trip
+    key = (engine, table_name)
+    with partitions_lock:
+        missing = sorted(months - partition_months.get(key, set()))
+    for month in missing:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {'key': f'partition {table_name}'})
+                create_month_partition(conn, table_name, month)
+            logging.info(f"{table_name}: Created the partition for {month:%Y-%m}.")
+        except Exception as e: # e.g. the default partition already has rows of that month, they keep going there
+            logging.error(f"{table_name}: Could not create the partition for {month:%Y-%m}, its rows go to {table_name}_default: {str(e)[:900]}")
+        with partitions_lock:
+            partition_months.setdefault(key, set()).add(month)
+# Remembers which columns each table already has, per engine, so the hot path does no DDL once a table is ready.
+# A header column the table has never seen is added with ALTER TABLE ADD COLUMN instead of failing the insert.
+table_columns = {}  # (engine, table name) -> set of column names
+table_columns_lock = threading.Lock()
+indexed_columns = ['sample_timestamp'] # Indexed in both databases, for time window queries on the real sample times
+source_key_columns = ['source_file_id', 'source_line', 'header_timestamp'] # Unique, a file saved over by a new test has new Data Header times
+
+def ensure_table_ready(target_engine, table_name, df, create_table):
+    key = (target_engine, table_name)
+    with table_columns_lock:
+        known_columns = table_columns.get(key)
+        if known_columns is not None and known_columns.issuperset(df.columns):
+            return True
+
+        first_check = known_columns is None
+        if first_check: # First time this process sees the table: create it and its sequence, then read its columns
+            if not create_table(target_engine, table_name, df):
+                return False
+            known_columns = {col['name'] for col in inspect(target_engine).get_columns(table_name)}
+
+        new_columns = [col for col in df.columns if col not in known_columns]
+        if new_columns:
+            with target_engine.begin() as conn:
+                for col in new_columns:
+                    sql_type = column_type(col)().compile(dialect=target_engine.dialect)
+                    conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS "{col}" {sql_type}'))
+            logging.info(f"{table_name}: Added new columns {new_columns}.")
+            known_columns = known_columns | set(new_columns)
+
+        index_columns = [col for col in indexed_columns if col in known_columns and (first_check or col in new_columns)]
+        if first_check and key in time_indexed_tables and timescale_time_column in known_columns:
+            index_columns.append(timescale_time_column)
+        source_key_index = known_columns.issuperset(source_key_columns) and (first_check or 'source_line' in new_columns)
+        table_columns[key] = known_columns
+
+    # Outside the lock, so other tables and the other database keep loading while an index is built on a big table
+    for col in index_columns:
+        try:
+            create_index(target_engine, table_name, f"{table_name}_{col}_idx", f'"{col}"')
+        except Exception as e:
+            logging.error(f"{table_name}: Could not create the index on {col}: {str(e)[:900]}")
+    if source_key_index:
+        create_source_key_index(target_engine, table_name)
+    return True
 
-            conn.commit()
+def create_index(target_engine, table_name, index_name, column_list, unique=False): # Without blocking inserts into the table where PostgreSQL can
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    with target_engine.execution_options(isolation_level='AUTOCOMMIT').connect() as conn: # CONCURRENTLY cannot run in a transaction
+        valid = conn.execute(text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index_name)"),
+                             {'index_name': f'"{index_name}"'}).scalar()
+        if valid:
+            return
+        if (target_engine, table_name) in hypertables: # No CONCURRENTLY on a hypertable, one transaction per chunk keeps each lock short
+            per_chunk = '' if unique else ' WITH (timescaledb.transaction_per_chunk)' # Which TimescaleDB does not allow for unique indexes
+            conn.execute(text(f'CREATE {kind} IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_list}){per_chunk}'))
+        elif (target_engine, table_name) in partitioned_tables: # Nor on a partitioned table, they are only made empty or by the partition command
+            conn.execute(text(f'CREATE {kind} IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_list})'))
+        else:
+            if valid is False: # Left behind by a build that was interrupted, it would never be finished
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'))
+            logging.info(f"{table_name}: Building {index_name}, rows keep going in meanwhile.")
+            try:
+                conn.execute(text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_list})'))
+            except Exception: # e.g. rows that break a unique index, the invalid index it leaves would slow every insert
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'))
+                raise
+
+def create_source_key_index(target_engine, table_name): # Without it rows loaded twice are simply stored twice, so a failure is only logged
+    key_columns = list(source_key_columns)
+    if (target_engine, table_name) in hypertables and timescale_time_column not in key_columns: # Unique indexes on a hypertable need its time column
+        key_columns.append(timescale_time_column)
+    key_columns += [col for col in partition_key_columns(target_engine, table_name) if col not in key_columns] # Likewise on a partitioned table
+    column_list = ', '.join(f'"{col}"' for col in key_columns)
+    try: # Rows from older versions have no source key, NULLs never conflict
+        create_index(target_engine, table_name, f"{table_name}_source_key_idx", column_list, unique=True)
+    except Exception as e:
+        logging.error(f"{table_name}: Could not create the source key index, rows loaded again will not be skipped: {str(e)[:900]}")
 
-            try:  # Attach the sequence to the id column, but only if it's not already attached
-                conn.execute(text(f"ALTER TABLE \"{table_name}\" ALTER COLUMN id SET DEFAULT nextval('{sequence_name}');"))
-            except Exception as e:
-                logging.error(f"Error attaching sequence to id column for {table_name}: {str(e)}")
+def forget_table(target_engine, table_name): # Check the table again next time, e.g. after a failed insert
+    with table_columns_lock:
+        table_columns.pop((target_engine, table_name), None)
+
+def copy_csv(df): # The rows as COPY reads them, missing values are written as empty fields, which COPY reads as NULL
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    return buffer.getvalue()
+
+statement_timeouts = {} # engine -> seconds, set by connect_databases()
+
+def limit_statement_time(execute, target_engine): # SET LOCAL ends with the transaction, table and index builds keep no limit
+    seconds = statement_timeouts.get(target_engine)
+    if seconds:
+        execute(f"SET LOCAL statement_timeout = {int(seconds * 1000)}")
+
+def insert_with_copy(df, table_name, target_engine, csv_text=None): # Stream the rows through COPY FROM STDIN, columns left out (id) keep their defaults
+    buffer = io.StringIO(copy_csv(df) if csv_text is None else csv_text) # csv_text is rendered once per batch for both databases
+
+    column_list = ', '.join('"' + col.replace('"', '""') + '"' for col in df.columns)
+    copy_sql = f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT csv)'
+
+    raw_conn = target_engine.raw_connection()
+    try:
+        with raw_conn.cursor() as cursor:
+            limit_statement_time(cursor.execute, target_engine)
+            cursor.copy_expert(copy_sql, buffer)
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+def insert_with_merge(df, table_name, target_engine, csv_text=None): # COPY into a temporary table, then insert the rows whose source key is new. Returns those rows.
+    buffer = io.StringIO(copy_csv(df) if csv_text is None else csv_text)
+
+    column_list = ', '.join('"' + col.replace('"', '""') + '"' for col in df.columns)
+    raw_conn = target_engine.raw_connection()
+    try:
+        with raw_conn.cursor() as cursor:
+            limit_statement_time(cursor.execute, target_engine)
+            cursor.execute(f'CREATE TEMPORARY TABLE staging ON COMMIT DROP AS SELECT {column_list} FROM "{table_name}" WITH NO DATA')
+            cursor.copy_expert(f'COPY staging ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(f'INSERT INTO "{table_name}" ({column_list}) SELECT {column_list} FROM staging ON CONFLICT DO NOTHING RETURNING source_file_id, source_line')
+            inserted_keys = cursor.fetchall()
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+    return df[pd.MultiIndex.from_arrays([df['source_file_id'], df['source_line']]).isin(inserted_keys)]
+
+def is_duplicate_key_error(e): # psycopg2 errors carry the SQLSTATE themselves, SQLAlchemy ones on .orig
+    return '23505' in (getattr(e, 'pgcode', None), getattr(getattr(e, 'orig', None), 'pgcode', None)) # unique_violation
+
+def is_statement_timeout_error(e):
+    return '57014' in (getattr(e, 'pgcode', None), getattr(getattr(e, 'orig', None), 'pgcode', None)) # query_canceled
+
+def insert_with_to_sql(df, table_name, target_engine):
+    with target_engine.begin() as conn: # pandas inserts in one transaction either way, SET LOCAL then covers every chunk
+        limit_statement_time(conn.exec_driver_sql, target_engine)
+        df.to_sql(table_name, conn, if_exists='append', index=False, chunksize=10000, dtype={
+            'etl_log_id': BigInteger(),
+            'header_timestamp': TIMESTAMP(),
+            'station_name': String()
+        })
+
+merging_tables = set() # (engine, table name) where the last batch had rows that were already loaded, e.g. during a backfill
+
+def insert_dataframe(df, table_name, target_engine, csv_text=None): # Insert with the configured method and report the insert rate, returns the rows that went in
+    method = 'merge' if (target_engine, table_name) in merging_tables and 'source_line' in df.columns else upload_method
+    start_time = time.perf_counter()
+    rows_in = len(df)
 
+    try:
+        if method == 'merge':
+            df = insert_with_merge(df, table_name, target_engine, csv_text)
+        elif method == 'copy':
+            try:
+                insert_with_copy(df, table_name, target_engine, csv_text)
+            except Exception as e: # COPY runs in one transaction, so nothing was written and the rows can go through to_sql instead
+                if is_duplicate_key_error(e) or is_statement_timeout_error(e): # to_sql would only be slower
+                    raise
+                logging.warning(f"{table_name}: COPY failed, falling back to to_sql: {str(e)[:900]}")
+                method = 'to_sql'
+                start_time = time.perf_counter()
+                insert_with_to_sql(df, table_name, target_engine)
+        else:
+            insert_with_to_sql(df, table_name, target_engine)
+    except Exception as e: # Some of the rows are already in the table, nothing was written, so merge the batch instead
+        if method == 'merge' or not is_duplicate_key_error(e) or 'source_line' not in df.columns:
+            raise
+        method = 'merge'
+        start_time = time.perf_counter()
+        df = insert_with_merge(df, table_name, target_engine, csv_text)
+
+    if method == 'merge': # Keep merging while batches overlap what is loaded, go back to plain inserts once they stop
+        if len(df) < rows_in:
+            merging_tables.add((target_engine, table_name))
+            logging.info(f"{table_name}: Skipped {rows_in - len(df)} rows that were already loaded.")
+        else:
+            merging_tables.discard((target_engine, table_name))
+
+    elapsed = time.perf_counter() - start_time
+    rows_per_second = rows_in / elapsed if elapsed > 0 else 0
+    logging.info(f"{table_name}: Inserted {len(df)} rows in {elapsed:.2f}s ({rows_per_second:.0f} rows/s) using {method}.")
+    return df
+
+########################################################################################## Rollups
+# Optional (ROLLUP_WINDOWS): min, max, mean, last and count of every channel per station and time window (on
+# sample_timestamp), kept in <table>_rollup_<window> next to the raw table in both databases. Each batch is rolled up on
+# its own and upserted, a window split over two batches, or over two runs when rows are appended later, is merged in SQL,
+# so overview plots read one row per station and window. etl_log_id is the latest load that added to the window.
+rollup_key_columns = ['station_name', 'window_start']
+
+def rollup_table_name(table_name, window):
+    return f"{table_name}_rollup_{window.lower()}"
+
+def compute_rollup(df, window):
+    data = df[df['sample_timestamp'].notna()]
+    channels = [col for col in data.columns if col not in ('id', 'etl_log_id') and pd.api.types.is_float_dtype(data[col])]
+    keys = [data['station_name'].fillna('').rename('station_name'), data['sample_timestamp'].dt.floor(window).rename('window_start')]
+    grouped = data.groupby(keys, sort=False)
+
+    rollup = grouped[channels].agg(['min', 'max', 'mean', 'last', 'count'])
+    rollup.columns = [f"{channel}_{stat}" for channel, stat in rollup.columns]
+    rollup['etl_log_id'] = grouped['etl_log_id'].max()
+    rollup['sample_count'] = grouped.size()
+    rollup['last_sample_timestamp'] = grouped['sample_timestamp'].max()
+    return rollup.reset_index()
+
+def create_rollup_table_if_not_exists(engine, table_name, df):
+    metadata = MetaData()
+    columns = [Column(col, column_type(col), primary_key=True) for col in rollup_key_columns]
+    columns += [Column(col, column_type(col)) for col in df.columns if col not in rollup_key_columns]
+    try:
+        if inspect(engine).has_table(table_name) and 'etl_log_id' in inspect(engine).get_pk_constraint(table_name)['constrained_columns']:
+            collapse_rollup_table(engine, table_name)
+        Table(table_name, metadata, *columns)
+        metadata.create_all(engine)
         logging.info(f"Table '{table_name}' is ready.")
-    
     except Exception as e:
         logging.error(f"Error creating table '{table_name}': {str(e)}")
         return False
-
     return True
 
+def collapse_rollup_table(engine, table_name): # Tables made before 6.14 had a row per etl_log_id in each window, merge them into one
+    with engine.begin() as conn:
+        columns = [col['name'] for col in inspect(conn).get_columns(table_name)]
+        primary_key = inspect(conn).get_pk_constraint(table_name)['name']
+        value_columns = [col for col in columns if col not in rollup_key_columns]
+        key_list = ', '.join(f'"{col}"' for col in rollup_key_columns)
+        conn.execute(text(f'CREATE TEMP TABLE rollup_collapsed ON COMMIT DROP AS SELECT {key_list}, '
+                          + ', '.join(f'{rollup_collapse_sql(col)} AS "{col}"' for col in value_columns)
+                          + f' FROM "{table_name}" GROUP BY {key_list}'))
+        conn.execute(text(f'TRUNCATE "{table_name}"'))
+        conn.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT "{primary_key}"'))
+        conn.execute(text(f'ALTER TABLE "{table_name}" ADD PRIMARY KEY ({key_list})'))
+        column_list = ', '.join(f'"{col}"' for col in columns)
+        merged = conn.execute(text(f'INSERT INTO "{table_name}" ({column_list}) SELECT {column_list} FROM rollup_collapsed')).rowcount
+    logging.info(f"{table_name}: Merged the rows of each station and window into one, {merged} rows.")
+
+def rollup_collapse_sql(column): # Like rollup_merge_sql, over all the rows of a window at once
+    channel, stat = column.rsplit('_', 1)
+    if column == 'sample_count':
+        return f'SUM("{column}")'
+    if column in ('last_sample_timestamp', 'etl_log_id'):
+        return f'MAX("{column}")'
+    if stat in ('min', 'max'):
+        return f'{stat.upper()}("{column}")'
+    if stat == 'count':
+        return f'SUM(COALESCE("{column}", 0))'
+    if stat == 'mean':
+        return f'SUM("{column}" * "{channel}_count") / NULLIF(SUM("{channel}_count"), 0)'
+    return f'(ARRAY_AGG("{column}" ORDER BY last_sample_timestamp DESC) FILTER (WHERE "{column}" IS NOT NULL))[1]'
+
+def rollup_merge_sql(column): # How a stored window and the same window from a new batch combine
+    channel, stat = column.rsplit('_', 1)
+    old, new = f't."{column}"', f'EXCLUDED."{column}"'
+    if column == 'sample_count':
+        return f'{old} + {new}'
+    if column == 'etl_log_id':
+        return f'GREATEST({old}, {new})'
+    if column == 'last_sample_timestamp':
+        return f'GREATEST({old}, {new})'
+    if stat == 'min':
+        return f'LEAST({old}, {new})'
+    if stat == 'max':
+        return f'GREATEST({old}, {new})'
+    if stat == 'count':
+        return f'COALESCE({old}, 0) + COALESCE({new}, 0)'
+    if stat == 'mean': # Weighted by how many values each side had
+        old_count, new_count = f'COALESCE(t."{channel}_count", 0)', f'COALESCE(EXCLUDED."{channel}_count", 0)'
+        return (f'CASE WHEN {old_count} + {new_count} = 0 THEN NULL ELSE '
+                f'(COALESCE({old} * {old_count}, 0) + COALESCE({new} * {new_count}, 0)) / ({old_count} + {new_count}) END')
+    # last: the newer batch wins, unless it has no value for this channel
+    return f'CASE WHEN {new} IS NOT NULL AND EXCLUDED.last_sample_timestamp >= t.last_sample_timestamp THEN {new} ELSE COALESCE({old}, {new}) END'
+
+def write_rollups(df, table_name, target_engine): # Best effort, the raw rows are already in, a failure is logged and counted
+    if 'sample_timestamp' not in df.columns: # Batches queued by older versions
+        return
+    start_time = time.perf_counter()
+    try:
+        rollups = [(rollup_table_name(table_name, window), compute_rollup(df, window)) for window in rollup_windows]
+        for rollup_table, rollup in rollups:
+            if not ensure_table_ready(target_engine, rollup_table, rollup, create_rollup_table_if_not_exists):
+                raise RuntimeError(f"Failed to create table {rollup_table}")
+
+        raw_conn = target_engine.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor: # All windows in one transaction
+                limit_statement_time(cursor.execute, target_engine)
+                for i, (rollup_table, rollup) in enumerate(rollups):
+                    buffer = io.StringIO()
+                    rollup.to_csv(buffer, index=False, header=False)
+                    buffer.seek(0)
+                    column_list = ', '.join('"' + col.replace('"', '""') + '"' for col in rollup.columns)
+                    value_columns = [col for col in rollup.columns if col not in rollup_key_columns]
+                    updates = ', '.join(f'"{col}" = {rollup_merge_sql(col)}' for col in value_columns)
+
+                    cursor.execute(f'CREATE TEMP TABLE rollup_batch_{i} (LIKE "{rollup_table}") ON COMMIT DROP')
+                    cursor.copy_expert(f'COPY rollup_batch_{i} ({column_list}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (station_name))', buffer)
+                    cursor.execute(f'INSERT INTO "{rollup_table}" AS t ({column_list}) SELECT {column_list} FROM rollup_batch_{i} '
+                                   f'ON CONFLICT (station_name, window_start) DO UPDATE SET {updates}')
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+        metrics.record('rollup', time.perf_counter() - start_time, table_name=table_name, rows=sum(len(rollup) for _, rollup in rollups))
+    except Exception as e:
+        for window in rollup_windows:
+            forget_table(target_engine, rollup_table_name(table_name, window))
+        metrics.record('rollup', time.perf_counter() - start_time, table_name=table_name, error=True)
+        logging.error(f"{table_name}: Rollup failed, the raw rows were inserted: {str(e)[:900]}")
+
+########################################################################################## Sinks
+# Each database is a sink with its own retry queue on disk. A batch counts as delivered to a sink once it is either
+# inserted or queued, so the file checkpoint can advance and a sink that is down never gets the same rows twice.
+# Batches are queued as zstd compressed Arrow IPC (Feather) files, pickles queued by versions before 6.14 are still
+# replayed. Once the queue holds RETRY_QUEUE_MAX_MB, batches are no longer queued and the files wait at their
+# checkpoints until the database is back.
+# A write that runs longer than the sink's statement timeout is cancelled by the server and queued like any other failure,
+# so a slow database holds up the checkpoint of the other one for that long at most.
+retry_queue_directory = os.getenv('RETRY_QUEUE_DIRECTORY', 'retry_queue')
+retry_queue_max_bytes = int(float(os.getenv('RETRY_QUEUE_MAX_MB', 10240)) * 1024**2) # 0 for no limit
+retry_interval = float(os.getenv('RETRY_INTERVAL_SECONDS', 30)) # How long a sink that failed is left alone before it is tried again
+primary_statement_timeout = float(os.getenv('PRIMARY_STATEMENT_TIMEOUT_SECONDS', 0)) # Longest a statement of a batch write may take, 0 for no limit
+timescale_statement_timeout = float(os.getenv('TIMESCALE_STATEMENT_TIMEOUT_SECONDS', 60))
+queue_extensions = ('.arrow', '.pkl')
+
+def read_queued_batch(batch_file):
+    return pd.read_feather(batch_file) if batch_file.endswith('.arrow') else pd.read_pickle(batch_file)
+
+def queued_rows(batch_file): # <time>_<rows>.<ext>, batches queued by older versions have no row count in the name
+    name = os.path.splitext(os.path.basename(batch_file))[0]
+    return int(name.split('_')[1]) if '_' in name else 0
+
+def queue_files(): # Every queued batch of every sink, as (sink, table, path, size)
+    found = []
+    if os.path.exists(retry_queue_directory):
+        for sink_name in sorted(os.listdir(retry_queue_directory)):
+            sink_directory = os.path.join(retry_queue_directory, sink_name)
+            if not os.path.isdir(sink_directory):
+                continue
+            for table_name in sorted(os.listdir(sink_directory)):
+                with os.scandir(os.path.join(sink_directory, table_name)) as entries:
+                    found += [(sink_name, table_name, entry.path, entry.stat().st_size) for entry in entries if entry.name.endswith(queue_extensions)]
+    return found
+
+def queue_metrics_text(): # Gauges per sink and table: batches, rows, bytes and age of the oldest batch
+    backlog = {}
+    now = time.time()
+    for sink_name, table_name, batch_file, size in queue_files():
+        totals = backlog.setdefault((sink_name, table_name), [0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += queued_rows(batch_file)
+        totals[2] += size
+        totals[3] = max(totals[3], now - int(os.path.basename(batch_file)[:20]) / 1e9)
+    series = [
+        ('etl_queue_batches', 'Batches waiting in the retry queue.', 0),
+        ('etl_queue_rows', 'Rows waiting in the retry queue.', 1),
+        ('etl_queue_bytes', 'Size of the retry queue on disk.', 2),
+        ('etl_queue_oldest_seconds', 'Age of the oldest queued batch.', 3),
+    ]
+    lines = []
+    for name, description, index in series:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+        for sink in sinks: # Zero for a sink with nothing queued, so alerts see the queue empty out
+            tables = [key for key in backlog if key[0] == sink.name] or [(sink.name, '')]
+            for key in sorted(tables):
+                value = backlog.get(key, [0, 0, 0, 0.0])[index]
+                lines.append(f'{name}{{sink="{key[0]}",table="{key[1]}"}} {value:.3f}' if index == 3 else f'{name}{{sink="{key[0]}",table="{key[1]}"}} {value}')
+    lines += ["# HELP etl_queue_max_bytes Size limit of the retry queue, 0 for none.", "# TYPE etl_queue_max_bytes gauge",
+              f"etl_queue_max_bytes {retry_queue_max_bytes}"]
+    return "\n".join(lines) + "\n"
+
+class DatabaseSink:
+    def __init__(self, name, target_engine, table_suffix, create_table):
+        self.name = name
+        self.engine = target_engine
+        self.table_suffix = table_suffix
+        self.create_table = create_table
+        self.queue_locks = {} # One lock per table so only one thread replays or adds to that table's queue at a time
+        self.queue_locks_guard = threading.Lock()
+        self.retry_after = 0 # time.monotonic() before which a sink that just failed is not tried again
+
+    def queue_lock(self, table_name):
+        with self.queue_locks_guard:
+            return self.queue_locks.setdefault(table_name, threading.Lock())
+
+    def queue_directory(self, table_name):
+        return os.path.join(retry_queue_directory, self.name, table_name)
+
+    def queued_batches(self, table_name):
+        directory = self.queue_directory(table_name)
+        if not os.path.exists(directory):
+            return []
+        return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(queue_extensions)]
+
+    def enqueue(self, df, table_name):
+        if retry_queue_max_bytes and sum(size for _, _, _, size in queue_files()) >= retry_queue_max_bytes:
+            raise RuntimeError(f"the retry queue is full ({retry_queue_max_bytes / 1024**2:.0f} MB), the file stays at its checkpoint")
+        directory = self.queue_directory(table_name)
+        os.makedirs(directory, exist_ok=True)
+        batch_file = os.path.join(directory, f"{time.time_ns():020d}_{len(df)}.arrow")
+        df.reset_index(drop=True).to_feather(batch_file + '.tmp', compression='zstd')
+        os.replace(batch_file + '.tmp', batch_file) # Only complete batches show up in the queue
+
+    def insert(self, df, table_name, csv_text=None):
+        target_table = f"{table_name}{self.table_suffix}"
+        if not ensure_table_ready(self.engine, target_table, df, self.create_table):
+            raise RuntimeError(f"Failed to create table {target_table}")
+        if (self.engine, target_table) in partitioned_tables and 'header_timestamp' in df.columns:
+            create_month_partitions(self.engine, target_table, month_starts(df['header_timestamp']))
+        if (self.engine, target_table) in hypertables and timescale_time_column in df.columns: # Rows without a time cannot go into a hypertable
+            missing_time = df[timescale_time_column].isna()
+            if missing_time.any():
+                logging.warning(f"{target_table}: Skipping {int(missing_time.sum())} rows without a {timescale_time_column}.")
+                df = df[~missing_time]
+                csv_text = None
+                if df.empty:
+                    return 0
+        try:
+            df = insert_dataframe(df, target_table, self.engine, csv_text)
+        except Exception as e:
+            if not is_statement_timeout_error(e): # A slow database says nothing about the table, checking it again would wait on the same locks
+                forget_table(self.engine, target_table)
+            raise
+        if rollup_windows and not df.empty: # Only the rows that went in, rows skipped as already loaded are in the rollups already
+            write_rollups(df, target_table, self.engine)
+        return len(df)
+
+    def retry_queued(self, table_name): # Replay queued batches oldest first, returns True once the queue is empty
+        batch_files = self.queued_batches(table_name)
+        while batch_files:
+            # Consecutive batches with the same columns go in as one insert, up to BATCH_ROWS rows
+            group, frames = [], []
+            for batch_file in batch_files:
+                df = read_queued_batch(batch_file)
+                if frames and (list(df.columns) != list(frames[0].columns) or sum(map(len, frames)) + len(df) > batch_rows):
+                    break
+                group.append(batch_file)
+                frames.append(df)
+            start_time = time.perf_counter()
+            try:
+                self.insert(pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0], table_name)
+            except Exception as e:
+                self.retry_after = time.monotonic() + retry_interval
+                logging.warning(f"{table_name}{self.table_suffix}: {self.name} is still unavailable, {len(batch_files)} batches queued: {str(e)[:900]}")
+                return False
+            for batch_file in group:
+                os.remove(batch_file)
+            metrics.record(f"replay_{self.name}", time.perf_counter() - start_time, table_name=table_name, rows=sum(map(len, frames)))
+            logging.info(f"{table_name}{self.table_suffix}: Replayed {len(group)} queued batches ({sum(map(len, frames))} rows) into {self.name}.")
+            batch_files = batch_files[len(group):]
+        return True
+
+    def retry_all_queued(self):
+        sink_directory = os.path.join(retry_queue_directory, self.name)
+        if os.path.exists(sink_directory):
+            for table_name in sorted(os.listdir(sink_directory)):
+                with self.queue_lock(table_name):
+                    self.retry_queued(table_name)
+
+    def write(self, df, table_name, csv_text=None): # Insert the batch, or queue it behind older batches if this sink is behind or down
+        with self.queue_lock(table_name):
+            if time.monotonic() < self.retry_after or not self.retry_queued(table_name): # Down a moment ago, queue without trying
+                self.enqueue(df, table_name)
+                return 'queued'
+
+        try: # Inserts from different files into the same table can run side by side
+            self.insert(df, table_name, csv_text)
+            return 'inserted'
+        except Exception as e:
+            self.retry_after = time.monotonic() + retry_interval
+            logging.error(f"{table_name}{self.table_suffix}: {self.name} insert failed, queued {len(df)} rows for retry: {str(e)[:900]}")
+            with self.queue_lock(table_name):
+                self.enqueue(df, table_name)
+            return 'queued'
+
+sinks = [] # Set up by connect_databases()
+sink_executor = None
+
+def has_queued_batches(): # Looks at the retry queue on disk only, without connecting
+    for _, _, filenames in os.walk(retry_queue_directory):
+        if any(f.endswith(queue_extensions) for f in filenames):
+            return True
+    return False
+
+def retry_queued_batches(): # Let every sink catch up on batches it missed, e.g. at the start of a run
+    for future in [sink_executor.submit(sink.retry_all_queued) for sink in sinks]:
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f"Error replaying queued batches: {str(e)[:900]}")
 
+def write_to_sink(sink, df, table_name, timings, csv_text=None): # sink.write, timed as insert_<sink name>, a queued batch counts as an error
+    with timings.stage(f"insert_{sink.name}") as counts:
+        outcome = sink.write(df, table_name, csv_text)
+        counts['rows'] = len(df) if outcome == 'inserted' else 0
+        counts['error'] = outcome == 'queued'
+    return outcome
 
-def upload_to_database(df, table_name):
+def upload_to_database(df, table_name, timings=None, csv_text=None): # csv_text, if given, is copy_csv(df) rendered ahead of time
     if df.empty:
         logging.info(f"{table_name}: No data to upload.")
         return False, 0
 
+    if 'id' in df.columns:
+        df = df.drop(columns=['id']) # Drop 'id' from the DataFrame to prevent it from interfering with autoincrement in the DB if it's in there
+        csv_text = None
+
+    # Write to the primary and TimescaleDB databases at the same time
+    timings = timings or FileTimings(table_name=table_name)
+    futures = [(sink, sink_executor.submit(write_to_sink, sink, df, table_name, timings, csv_text)) for sink in sinks]
+    delivered = True
+    for sink, future in futures:
+        try:
+            outcome = future.result()
+            logging.info(f"{table_name}{sink.table_suffix}: {len(df)} rows {outcome} for {sink.name}.")
+        except Exception as e: # Neither inserted nor queued, the file checkpoint must not move
+            logging.error(f"{table_name}{sink.table_suffix}: An error occurred during database interaction: {str(e)[:900]}...")
+            delivered = False
+
+    if not delivered:
+        return False, 0
+    return True, len(df)
+
+############################################################################################ Entry points
+def fingerprint_directory(directory): # Size, mod time and inode from the directory listing, the files are not opened
+    rows = []
+    if directory and os.path.exists(directory):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    # The end of file offset is the checkpoint, the line count and head hash are filled in when the file next changes
+                    rows.append((os.path.join(directory, entry.name), stat.st_mtime, stat.st_size, entry.inode(), stat.st_size))
+    return rows
+
+def initialize_state(directories): # First run: start every existing file from its current end
+    logging.info("First run detected. Initializing file fingerprints and checkpoints.")
+
+    with ThreadPoolExecutor(max_workers=max(1, len(directories)), thread_name_prefix='init') as directory_pool: # Network shares answer in parallel
+        rows = [row for directory_rows in directory_pool.map(fingerprint_directory, directories) for row in directory_rows]
+
+    with state_transaction() as db:
+        db.executemany("INSERT OR REPLACE INTO files (path, mod_time, size, inode, byte_offset) VALUES (?, ?, ?, ?, ?)", rows)
+        write_counter(db, 'initialized', 1)
+
+    logging.info(f"Initialization complete for {len(rows)} files. No processing needed on the first run.")
+
+stop_requested = threading.Event()
+
+def request_stop(signum, frame):
+    logging.info(f"Received signal {signum}, stopping after the current cycle.")
+    stop_requested.set()
+
+def open_directory_watcher(directories): # inotify on Linux if inotify_simple is installed, otherwise None and the daemon just polls
+    if not sys.platform.startswith('linux'):
+        return None
     try:
-        logging.info(f"{table_name}: Connecting to the database for table.")
-        
-        if create_table_if_not_exists(engine, table_name, df):
-            df = df.drop(columns=['id'], errors='ignore') # Drop 'id' from the DataFrame to prevent it from interfering with autoincrement in the DB if it's in there
-            
-            logging.info(f"{table_name}: Inserting data into the table in chunks.")
-            df.to_sql(table_name, engine, if_exists='append', index=False, chunksize=10000, dtype={
-                'etl_log_id': BigInteger(), 
-                'header_timestamp': TIMESTAMP(),
-                'station_name': String()
-            })
-            rows_inserted = len(df)
-            logging.info(f"{table_name}: Successfully inserted {rows_inserted} rows.")
-            
-            # Now insert into the TimescaleDB database
-
-            if create_table_if_not_exists_ts(timescale_engine, f"{table_name}_ts", df):
-                logging.info(f"Inserting data into the TimescaleDB table {table_name}_ts in chunks.")
-                df.to_sql(f"{table_name}_ts", timescale_engine, if_exists='append', index=False, chunksize=10000, dtype={
-                    'etl_log_id': BigInteger(), 
-                    'header_timestamp': TIMESTAMP(),
-                    'station_name': String()
-                })
-                logging.info(f"{table_name}_ts: Successfully inserted {rows_inserted} rows into TimescaleDB.")
-                return True, rows_inserted
-        else:
-            logging.error(f"{table_name}: Failed to create table or it already exists.")
-            return False, 0 
+        from inotify_simple import INotify, flags
+    except ImportError:
+        logging.info("inotify_simple is not installed, polling the directories instead.")
+        return None
 
-    except Exception as e:
-        logging.error(f"{table_name}: An error occurred during database interaction: {str(e)[:900]}...")
-        return False, 0 
+    watcher = INotify()
+    for directory in directories:
+        if directory and os.path.exists(directory):
+            watcher.add_watch(directory, flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.MOVED_TO)
+    return watcher
+
+def wait_for_changes(watcher, poll_interval):
+    if watcher is None:
+        stop_requested.wait(poll_interval)
+    else:
+        watcher.read(timeout=int(poll_interval * 1000)) # Returns as soon as something in a watched directory changes
+
+def run_daemon(directories, poll_interval, metrics_port=0): # Keep the engines, mod times and last lines in memory and ingest changes as they show up
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    create_logging_tables_if_not_exists()
+    load_fingerprints()
+    watcher = open_directory_watcher(directories)
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
+    logging.info(f"Daemon started, checking for changes every {poll_interval}s{' (inotify)' if watcher else ''}.")
+
+    try:
+        while not stop_requested.is_set():
+            try:
+                create_logging_tables_if_not_exists() # Only does something until the database has been reached once
+                retry_queued_batches()
+                changes = scan_directories(directories, file_fingerprints)
+                if coordinated() and logging_tables_ready:
+                    add_abandoned_files(changes)
+                if changes:
+                    logging.info(f"Modified files detected: {list(changes)}")
+                    save_changes(changes, file_fingerprints)
+                    process_and_upload_files(list(changes), restarted_files(changes))
+            except Exception as e: # Keep the daemon alive, e.g. when a network share is briefly unavailable
+                logging.error(f"Error during daemon cycle: {str(e)[:900]}")
+
+            metrics.end_pass()
+            write_metrics_file()
+            wait_for_changes(watcher, poll_interval)
+    finally:
+        shutdown_parse_pool()
+        close_state_store()
+        if watcher is not None:
+            watcher.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        logging.info("Daemon stopped, checkpoints saved.")
+
+############################################################################################ Backfill
+# Loads old files again from the first line, whatever the normal checkpoints say, e.g. after a table was lost or for a new
+# station. Progress is saved per file in backfill_files in the state store, so a stopped backfill carries on where it was.
+# Rows already in a table are skipped by their source key, so running a backfill twice does not duplicate anything.
+def parse_date(value): # --since / --until, a day or a day and time
+    for date_format in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"not a date: {value} (use YYYY-MM-DD)")
+
+def find_backfill_files(paths, since=None, until=None): # Files, directories (not their subdirectories) and glob patterns, by mod time
+    found = set()
+    for path in paths:
+        for match in glob.glob(path, recursive=True) or [path]: # ** in a pattern matches subdirectories
+            if os.path.isdir(match):
+                with os.scandir(match) as entries:
+                    found.update(os.path.join(match, entry.name) for entry in entries if entry.is_file())
+            elif os.path.isfile(match):
+                found.add(match)
+            else:
+                logging.warning(f"Backfill: {match} not found.")
+
+    files = []
+    for file_path in sorted(found):
+        mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
+        if (since is None or mod_time >= since) and (until is None or mod_time < until):
+            files.append(file_path)
+    return files
+
+def format_duration(seconds):
+    return f"{seconds / 3600:.1f} h" if seconds >= 3600 else f"{seconds / 60:.0f} min" if seconds >= 60 else f"{seconds:.0f} s"
+
+def run_backfill(paths, since=None, until=None, restart=False):
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    files = find_backfill_files(paths, since, until)
+    if not files:
+        logging.info("Backfill: no files matched.")
+        return
+
+    create_logging_tables_if_not_exists()
+    if restart: # Forget earlier progress, the rows already loaded are still skipped by their source key
+        with state_transaction() as db:
+            db.executemany("DELETE FROM backfill_files WHERE path = ?", [(f,) for f in files])
+
+    checkpoints = {f: read_last_processed_line(f, 'backfill_files') for f in files}
+    sizes = {f: os.path.getsize(f) for f in files}
+    pending = [f for f in files if (checkpoints[f]['offset'] or 0) < sizes[f]]
+    total_bytes = sum(sizes.values())
+    done_bytes = sum(min(checkpoints[f]['offset'] or 0, sizes[f]) for f in files)
+    logging.info(f"Backfill: {len(files)} files, {total_bytes / 1024**2:.0f} MB, {len(files) - len(pending)} already done, "
+                 f"{(total_bytes - done_bytes) / 1024**2:.0f} MB to load with {etl_workers} workers.")
+    if not pending:
+        return
+
+    etl_log_ids = reserve_etl_log_ids(len(pending))
+    pool = get_parse_pool() if etl_workers > 1 and total_bytes - done_bytes >= parse_process_min_bytes else None
+    start_time = time.perf_counter()
+    loaded_bytes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=etl_workers, thread_name_prefix='backfill') as file_pool:
+            futures = {file_pool.submit(process_and_upload_file, input_file, checkpoints[input_file], etl_log_id, pool,
+                                        None, 'backfill_files'): input_file
+                       for input_file, etl_log_id in zip(pending, etl_log_ids)}
+            for files_done, future in enumerate(as_completed(futures), 1):
+                if future.cancelled(): # Not started before the stop, it stays pending for the next backfill
+                    continue
+                future.result()
+                input_file = futures[future]
+                offset = read_last_processed_line(input_file, 'backfill_files')['offset'] or 0
+                loaded_bytes += max(0, offset - (checkpoints[input_file]['offset'] or 0))
+                elapsed = time.perf_counter() - start_time
+                rate = loaded_bytes / elapsed if elapsed > 0 else 0
+                remaining = total_bytes - done_bytes - loaded_bytes
+                logging.info(f"Backfill: {files_done}/{len(pending)} files, {(done_bytes + loaded_bytes) / 1024**2:.0f} of "
+                             f"{total_bytes / 1024**2:.0f} MB ({100 * (done_bytes + loaded_bytes) / total_bytes:.1f}%), "
+                             f"{rate / 1024**2:.1f} MB/s, {format_duration(remaining / rate) + ' left' if rate else 'estimating'}.")
+                if stop_requested.is_set():
+                    for other in futures: # Files not started yet stay pending, the ones running stop after their current batch
+                        other.cancel()
+    finally:
+        shutdown_parse_pool()
+        close_state_store()
+
+    if stop_requested.is_set():
+        logging.info("Backfill stopped, run the same command again to carry on from the saved progress.")
+    else:
+        logging.info(f"Backfill finished in {format_duration(time.perf_counter() - start_time)}.")
+
+############################################################################################ Hypertable
+def run_hypertable(table_names): # Turn plain _ts tables with rows into hypertables, one table and one transaction at a time
+    create_logging_tables_if_not_exists()
+    if not timescale_enabled(timescale_engine):
+        logging.error(f"TimescaleDB is not available in {timescale_db_name}, nothing to convert.")
+        return
+    for table_name in [f"{name}_ts" for name in table_names]:
+        if table_kind(timescale_engine, table_name) is None:
+            logging.info(f"{table_name}: No such table, nothing to convert.")
+            continue
+        start_time = time.perf_counter()
+        try:
+            setup_hypertable(timescale_engine, table_name, convert=True)
+            columns = {col['name'] for col in inspect(timescale_engine).get_columns(table_name)}
+            for col in indexed_columns:
+                if col in columns:
+                    create_index(timescale_engine, table_name, f"{table_name}_{col}_idx", f'"{col}"')
+            if columns.issuperset(source_key_columns):
+                create_source_key_index(timescale_engine, table_name)
+        except Exception as e: # The conversion is one transaction, a failed one leaves the plain table as it was
+            logging.error(f"{table_name}: Could not convert to a hypertable: {str(e)[:900]}")
+            continue
+        logging.info(f"{table_name}: Hypertable ready in {format_duration(time.perf_counter() - start_time)}.")
+
+############################################################################################ Partition
+def run_partition(table_names): # Move plain primary tables into monthly partitions, one table and one transaction at a time
+    create_logging_tables_if_not_exists()
+    for table_name in table_names:
+        kind = table_kind(engine, table_name)
+        if kind != 'r':
+            logging.info(f"{table_name}: {'Already partitioned' if kind == 'p' else 'No such table'}, nothing to move.")
+            continue
+        start_time = time.perf_counter()
+        try:
+            setup_partitioned_table(engine, table_name, migrate=True)
+            columns = {col['name'] for col in inspect(engine).get_columns(table_name)}
+            for col in indexed_columns:
+                if col in columns:
+                    create_index(engine, table_name, f"{table_name}_{col}_idx", f'"{col}"')
+            if columns.issuperset(source_key_columns):
+                create_source_key_index(engine, table_name)
+        except Exception as e: # The move is one transaction, a failed one leaves the plain table as it was
+            logging.error(f"{table_name}: Could not move the rows into partitions: {str(e)[:900]}")
+            continue
+        logging.info(f"{table_name}: Partitioned in {format_duration(time.perf_counter() - start_time)}.")
 
 ############################################################################################
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load new rows from MTS .dat files into PostgreSQL and TimescaleDB.")
+    parser.add_argument('--daemon', action='store_true', help="keep running and load changes as they happen instead of a single pass")
+    parser.add_argument('--poll-interval', type=float, default=float(os.getenv('POLL_INTERVAL_SECONDS', 5)),
+                        help="seconds between directory checks in daemon mode (default 5, or POLL_INTERVAL_SECONDS)")
+    parser.add_argument('--metrics-port', type=int, default=metrics_port,
+                        help="serve Prometheus metrics on this port in daemon mode (default off, or METRICS_PORT)")
+    subparsers = parser.add_subparsers(dest='command')
+    backfill_parser = subparsers.add_parser('backfill', help="load old files again from the start, skipping rows that are already loaded")
+    backfill_parser.add_argument('paths', nargs='+', help="files, directories or glob patterns (quote them, ** matches subdirectories)")
+    backfill_parser.add_argument('--since', type=parse_date, help="only files modified on or after this date (YYYY-MM-DD)")
+    backfill_parser.add_argument('--until', type=parse_date, help="only files modified before the end of this date (YYYY-MM-DD)")
+    backfill_parser.add_argument('--workers', type=int, default=etl_workers, help="files loaded at the same time (default ETL_WORKERS)")
+    backfill_parser.add_argument('--restart', action='store_true', help="ignore the saved backfill progress for these files")
+    partition_parser = subparsers.add_parser('partition', help="move the rows of plain primary tables into monthly partitions")
+    partition_parser.add_argument('tables', nargs='*', default=['table_top', 'rotary', 'mts_810'], help="tables to move (default all three)")
+    partition_parser.add_argument('--by', choices=['month', 'month,station'], default=primary_partitioning or 'month',
+                                  help="month, or month and station (default PRIMARY_PARTITIONING, or month)")
+    hypertable_parser = subparsers.add_parser('hypertable', help="move the rows of plain _ts tables into TimescaleDB hypertable chunks")
+    hypertable_parser.add_argument('tables', nargs='*', default=['table_top', 'rotary', 'mts_810'], help="tables to convert, without _ts (default all three)")
+    args = parser.parse_args()
+
+    if args.command == 'backfill': # Leaves the normal checkpoints alone, the next normal run carries on as before
+        etl_workers = args.workers
+        until = args.until + timedelta(days=1) if args.until and args.until.time() == datetime.min.time() else args.until # A date on its own includes that day
+        run_backfill(args.paths, args.since, until, args.restart)
+        metrics.end_pass()
+        write_metrics_file()
+        sys.exit(0)
+
+    if args.command == 'hypertable': # Like partition, stop scheduled runs and the daemon first
+        run_hypertable(args.tables)
+        sys.exit(0)
+
+    if args.command == 'partition': # Stop scheduled runs and the daemon first, the tables are locked while their rows move
+        primary_partitioning = args.by
+        run_partition(args.tables)
+        sys.exit(0)
+
     directories = [
         os.getenv('DIRECTORY_1'),
         os.getenv('DIRECTORY_2'),
@@ -553,50 +2332,32 @@ if __name__ == "__main__":
         os.getenv('DIRECTORY_4')
     ]
 
-    create_logging_tables_if_not_exists()
-    mod_log_file = 'mod_times.txt'
-    last_lines_file = 'last_lines.txt'
-
     # Check if it's the first run
-    if not os.path.exists(mod_log_file) or not os.path.exists(last_lines_file):
-        logging.info("First run detected. Initializing file modification times and last_lines.txt.")
-        
-        last_lines = {}
-        last_mod_times = {}
-
-        # Populate both files with current data
-        for directory in directories:
-            if os.path.exists(directory):
-                for filename in os.listdir(directory):
-                    file_path = os.path.join(directory, filename)
-                    if os.path.isfile(file_path):
-                        # Get the current last line number and modification time
-                        last_lines[file_path] = get_last_line_of_file(file_path)
-                        last_mod_times[file_path] = os.path.getmtime(file_path)
-
-        # Save the last lines to last_lines.txt
-        with open(last_lines_file, 'w') as f:
-            for file_path, last_line in last_lines.items():
-                f.write(f"{file_path}\t{last_line}\n")
-
-        # Save the modification times to mod_times.txt
-        with open(mod_log_file, 'w') as f:
-            for file_path, mod_time in last_mod_times.items():
-                f.write(f"{file_path}\t{mod_time}\n")
-
-        logging.info("Initialization complete. No processing needed on the first run.")
-    
-    else:
-        # Not the first run: proceed with normal processing
-        last_lines = load_last_processed_lines()
-        modified_files = track_modified_files(mod_log_file, directories)
-
-        if modified_files:
-            logging.info(f"Modified files detected: {modified_files}")
-            process_and_upload_files(modified_files, last_lines)
-            save_last_processed_lines(last_lines)
+    first_run = is_first_run()
+    if first_run:
+        initialize_state(directories)
+
+    if args.daemon:
+        run_daemon(directories, args.poll_interval, args.metrics_port)
+
+    elif not first_run:
+        # Not the first run: scan first, the databases are only connected to if there is something to load
+        changes = track_modified_files(directories)
+
+        if changes or has_queued_batches() or coordinated(): # Coordinated runs also look for files other hosts left unfinished
+            if create_logging_tables_if_not_exists() and coordinated(): # If the database is down the new rows are queued on disk, the files are not read again
+                add_abandoned_files(changes)
+            save_changes(changes, file_fingerprints)
+            retry_queued_batches()
+
+        if changes:
+            logging.info(f"Modified files detected: {list(changes)}")
+            process_and_upload_files(list(changes), restarted_files(changes))
         else:
             logging.info("No modified files found in any of the folders.")
+
+        metrics.end_pass()
+        write_metrics_file()
 ############################################################# 
 '''
 Versions
@@ -615,6 +2376,130 @@ Versions
 
 4 2024-11-13 Etl_log will now display rows inserted. Removed warning for directories not existing. 
 (Also changed task scheduler to run on the hour so every 5 minute mark)
+
+4.1 2026-10-17 last_lines.txt now also stores a byte offset per file. Only the bytes appended since the last run are read,
+a partially written last line is left for the next run. Old two column last_lines.txt files still load.
+
+4.2 2026-10-17 Data is now bulk loaded with COPY FROM STDIN into both databases (UPLOAD_METHOD=copy, the default).
+UPLOAD_METHOD=to_sql keeps the old pandas inserts, which are also used if a COPY fails. Rows/s is logged per table.
+
+4.3 2026-10-17 process_data_file parses each data block in one go with pandas instead of line by line.
+Rows with the wrong column count or non-numeric cells are still dropped.
+
+5 2026-10-17 Added --daemon mode. The script keeps running with the engines, mod times and last lines in memory,
+checks the directories every --poll-interval seconds (or wakes up on inotify events on Linux when inotify_simple is installed)
+and saves its checkpoints after each cycle and on Ctrl+C / SIGTERM. Without --daemon it still does a single pass for Task Scheduler.
+
+5.1 2026-10-17 The primary and TimescaleDB inserts now run at the same time. If one database fails, its rows go to a
+retry queue on disk (retry_queue/<sink>/<table>/) and are replayed in order on the next run, so the file checkpoint
+still advances and the database that worked does not get the same rows again.
+
+5.2 2026-10-17 Modified files are now processed in parallel (ETL_WORKERS, default 4). Parsing moves to a process pool
+when there is more than PARSE_PROCESS_MIN_BYTES of new data across several files. etl_log_ids are handed out up front
+and last_lines is only updated from the main thread.
+
+5.3 2026-10-17 Tables and sequences are checked once per process and remembered, so uploads no longer run DDL every time.
+A new header column is added to the table with ALTER TABLE ADD COLUMN instead of failing the insert.
+
+5.4 2026-10-17 error_log is written in batches from a background thread instead of one connection per log line
+(DB_LOG_BATCH_SIZE, DB_LOG_FLUSH_SECONDS). The level sent to error_log is set with DB_LOG_LEVEL.
+If the queue fills up or the database is down, records are only kept in the text log. The queue is drained on exit.
+
+5.5 2026-10-17 Files are streamed in batches (BATCH_MB / BATCH_ROWS) instead of being parsed into one DataFrame, so memory
+no longer grows with file size. last_lines.txt is saved after every uploaded batch together with the headers and parser
+state, so a run that stops part way through a file carries on from the last uploaded batch.
+
+6 2026-10-17 mod_times.txt, last_lines.txt and etl_log_id.txt are replaced by one SQLite state store (STATE_DB, default
+etl_state.db, WAL mode). The text files are imported on the first run of this version and renamed to *.migrated.
+Checkpoints, mod times and etl_log_ids are saved in small transactions per file instead of rewriting whole files.
+
+6.1 2026-10-17 The directory scan uses os.scandir and compares each file's size and mod time with the state store, so
+unchanged files are never opened. Changed files are fingerprinted (inode, size, mod time, hash of the first 4 KB) and
+sorted into appended, truncated or replaced. Truncated and replaced files are loaded again from the first line.
+
+6.2 2026-10-17 The first run no longer reads every file to count its lines. It only records each file's size, mod time and
+inode (all directories at the same time), with the end of the file as the checkpoint. The line count is worked out when a
+file next changes.
+
+6.3 2026-10-17 The directories are scanned before anything else. pandas and SQLAlchemy are only imported, and the databases
+(engines, error_log handler, logging tables) only set up, when there are changed files or queued batches to load.
+File fingerprints are saved after connecting, so changes are picked up again if the database is down.
+
+6.4 2026-10-17 Added per stage metrics (scan, read, parse, insert_primary, insert_timescale, checkpoint) with calls, seconds,
+rows, bytes and errors per station and table. They are written as Prometheus text to METRICS_FILE after every pass and served on
+--metrics-port / METRICS_PORT in daemon mode. etl_log gets <stage>_seconds, total_seconds and bytes_read columns, and
+minutes_since_last_run is now filled in.
+
+6.5 2026-10-17 The _ts tables are now TimescaleDB hypertables on header_timestamp (TIMESCALE_CHUNK_INTERVAL), compressed
+segmented by station_name after TIMESCALE_COMPRESS_AFTER, with an optional TIMESCALE_RETENTION policy. Existing plain _ts
+tables are converted in place. Without the timescaledb extension they stay plain tables with an index on header_timestamp.
+
+6.6 2026-10-17 Rows get a sample_timestamp column, the Data Header time plus the row's Time channel in seconds (header time
+alone if Time is missing), to the microsecond. It is added to existing tables and indexed in both databases.
+
+6.7 2026-10-17 Optional rollups (ROLLUP_WINDOWS, e.g. 1s,1min,1h): every inserted batch is also summarised per station,
+etl_log_id and sample_timestamp window into <table>_rollup_<window> in both databases (min, max, mean, last and count per
+channel). Windows split over batches are merged with an upsert. A failed rollup is logged, the raw rows are not affected.
+
+6.8 2026-10-17 Added the backfill command (python etl_mts_771.py backfill <files, folders or globs> --since --until --workers
+--restart) to load old files again from the start with a worker pool. Rows get a source key, source_file_id (a hash of the
+file path, which etl_log now records with the path) and source_line, with a unique index on it and header_timestamp. Rows
+that are already loaded are skipped: a batch that hits the index is merged through a staging table with ON CONFLICT DO
+NOTHING. Backfill progress is saved per batch apart from the normal checkpoints, so a stopped backfill carries on.
+
+6.9 2026-10-17 Appended rows are parsed straight from the headers, table, station, test file name and Data Header time saved
+with the checkpoint, without looking for headers in the new data first. Checkpoints without them (first run, older
+versions) get them once from the part of the file before the checkpoint, so rows appended to a file that was part way
+through a block at first run are loaded instead of failing with "No valid headers found". A new header block in the
+appended data is checked against the saved headers: new columns for the same table are used from there on, headers for
+another table have that block skipped and logged.
+
+6.10 2026-10-17 The retry queue keeps batches as zstd compressed Arrow IPC files when pyarrow is installed (pickles
+otherwise, older pickles are still replayed) and is capped at RETRY_QUEUE_MAX_MB: when it is full, files stay at their
+checkpoints instead. Queued batches are replayed oldest first in bulk, consecutive batches with the same columns as one
+insert of up to BATCH_ROWS rows. A database that failed is not tried again for RETRY_INTERVAL_SECONDS, batches go straight
+to the queue. A run no longer stops when the database is down at the start, the rows are queued and the checkpoints
+advance. The queue backlog (batches, rows, bytes, age of the oldest batch per sink and table) is in the metrics.
+
+6.11 2026-10-17 Each file is now a two stage pipeline: a reader thread reads and parses the next batches (up to
+PIPELINE_DEPTH ahead, default 2) while the file's own thread uploads the current one to both databases and saves its
+checkpoint. Uploads and checkpoints keep their order, a failed upload or a stop still ends the file at the last
+checkpoint. PIPELINE_DEPTH=0 goes back to one step after the other. The COPY text of a batch is rendered once in the
+reader stage and used for both databases, instead of once per database during the upload.
+
+6.12 2026-10-17 COORDINATION=postgres lets several hosts load the same folders without loading a file twice. A host
+leases each file in etl_leases before loading it, renews the lease every LEASE_SECONDS/3 while it loads and deletes it
+when the file is done. Checkpoints move to etl_checkpoints and are only saved under the lease, etl_log_ids come from the
+etl_log_id_seq sequence. When a host dies its leases run out and the next scan of another host takes the files over from
+their last checkpoints. Without COORDINATION everything stays in the local state store as before.
+
+6.13 2026-10-17 PRIMARY_PARTITIONING=month (or month,station) makes table_top, rotary and mts_810 in the primary database
+native partitioned tables by header_timestamp month, optionally hash partitioned by station_name within each month
+(STATION_PARTITIONS). Months are created PARTITION_MONTHS_AHEAD ahead and when a batch has rows for a new month, rows
+without a header_timestamp go to a default partition. The tables get a BRIN index on header_timestamp and B-tree indexes
+on etl_log_id and station_name, header_timestamp, and no id primary key. Existing plain tables are moved into partitions
+in one transaction, keeping their ids and id sequence. The id column is no longer a BIGSERIAL, so the start values per
+table (rotary from 2*10^18, mts_810 from 3*10^18) now apply to new tables, in the _ts tables too, and the id default is
+committed.
+
+6.14 2026-10-17 Rollups are keyed on station and window only, etl_log_id is kept as the latest load that added to the
+window, so rows appended in a later run or daemon pass merge into the window they fall in instead of adding a row per
+etl_log_id. Existing rollup tables are merged down to one row per station and window the first time they are used.
+sample_timestamp is the Data Header time plus Time minus the Time of the block's first row, instead of plus Time itself,
+Time is the running test time and does not start again at 0 in each block. The block's first Time is saved with the
+checkpoint, older checkpoints get it from the file once. The source key and sample_timestamp indexes are built with
+CREATE INDEX CONCURRENTLY (per chunk on hypertables, except the unique source key index) after the table lock of the
+schema registry is released, so building them on a big existing table no longer holds up every other table and the
+other database. Plain primary tables are no longer moved into partitions by the first upload, which held the schema
+registry lock for the whole copy: that is now the partition command (python etl_mts_771.py partition [tables] --by
+month|month,station), until then they keep loading as plain tables. The same goes for plain _ts tables with rows and
+the hypertable command (python etl_mts_771.py hypertable [tables]), empty ones are still made hypertables right away.
+Without the timescaledb extension the header_timestamp index of the _ts tables is built like the other indexes.
+Batch writes run with a server side statement_timeout per database (PRIMARY_STATEMENT_TIMEOUT_SECONDS, off by default,
+TIMESCALE_STATEMENT_TIMEOUT_SECONDS, 60 by default), a write that is cancelled is queued for retry like one to a database
+that is down, so a slow TimescaleDB no longer holds up the checkpoint of the primary tables. COPY timeouts do not fall
+back to to_sql. pyarrow is in requirements.txt and the retry queue is always written as Arrow IPC, queued pickles are
+still replayed.
  
 '''
 #############################################################